@@ -0,0 +1,126 @@
+#####################################################################
+# TH260 benchmarks
+#
+# Times the storage of synthetic time tags, and each stage of the
+# server pipeline on simulated FiFo records, run with
+#     python TH260_benchmark.py [storage|pipeline] [n_events ...]
+# 1e8 events need about 4 GB of memory
+#####################################################################
+
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+import time
+import numpy as np
+import h5py
+
+from TH260_processing import create_time_dataset, read_timestamps, to_seconds, decode_t2, segment_traces, RecordBuffer
+from TH260_dev_dummy import synthetic_t2_records, TTREADMAX
+
+RESOLUTION = 250. # ps
+MEAN_RATE = 1e6 # events per s
+
+# name, timestamp dtype, encoding, compression, compression_opts
+STORAGE_CASES = [
+    ('float gzip (legacy)', 'float', 'plain', 'gzip', None),
+    ('tags gzip', np.uint64, 'plain', 'gzip', None),
+    ('tags delta lzf', np.uint64, 'delta', 'lzf', None),
+    ('tags delta gzip 1', np.uint64, 'delta', 'gzip', 1),
+]
+
+# simulated shot of the pipeline benchmark : 10 exposures of 50 ms over 1 s
+PIPELINE_EXPOSURES = [(0.1*i, 0.05) for i in range(10)]
+PIPELINE_DURATION = 1.05 # in s
+
+
+def synthetic_tags(n, rate=MEAN_RATE, resolution=RESOLUTION, seed=0):
+    """Sorted time tags of a Poisson stream of n events at rate (per s)"""
+    rng = np.random.RandomState(seed)
+    mean_delta = 1. / (rate * resolution * 1e-12)
+    deltas = rng.exponential(mean_delta, size=n).astype(np.uint64) + 1
+    return np.cumsum(deltas, dtype=np.uint64)
+
+
+def bench_storage(n, directory):
+    """
+    Writes n time tags with each of STORAGE_CASES and prints the write speed,
+    in MB/s of float64 input, and the compression ratio against float64
+    """
+    tags = synthetic_tags(n)
+    seconds = to_seconds(tags, RESOLUTION)
+    raw_size = seconds.nbytes
+    print('%d events (%.1f MB as float64)' % (n, raw_size/1e6))
+    for name, dtype, encoding, compression, compression_opts in STORAGE_CASES:
+        data = seconds if dtype == 'float' else tags
+        path = os.path.join(directory, 'bench.h5')
+        t0 = time.time()
+        with h5py.File(path, 'w') as f:
+            dset = create_time_dataset(f, 'times', data, dtype, encoding, compression, compression_opts)
+            stored = dset.id.get_storage_size()
+        elapsed = time.time() - t0
+        with h5py.File(path, 'r') as f:
+            assert np.array_equal(read_timestamps(f['times']), data)
+        os.remove(path)
+        print('    %-22s %8.1f MB/s    ratio %5.2f' % (name, raw_size/1e6/elapsed, raw_size/float(max(stored, 1))))
+
+
+def bench_pipeline(n, directory):
+    """
+    Runs the stages of a T2 shot on the server on raw records of about n
+    photons and prints the time and events/s of each : FiFo drain (copy in
+    the record buffer by reads of TTREADMAX), decode, segmentation per
+    exposure and HDF5 write ('groups' layout, tags, gzip)
+    """
+    records = synthetic_t2_records(PIPELINE_EXPOSURES, n/PIPELINE_DURATION, duration=PIPELINE_DURATION,
+                                   resolution=RESOLUTION, start_delay=0., seed=0)
+    timings = []
+
+    t0 = time.time()
+    buffer = RecordBuffer(8*TTREADMAX)
+    for i in range(0, records.size, TTREADMAX):
+        buffer.append(records[i:i+TTREADMAX])
+    timings.append(('drain', time.time() - t0))
+
+    t0 = time.time()
+    sync_times, times, channels, oflcorrection = decode_t2(buffer.view())
+    timings.append(('decode', time.time() - t0))
+
+    t0 = time.time()
+    traces, opens = segment_traces(times, sync_times[:2*len(PIPELINE_EXPOSURES)])
+    timings.append(('segment', time.time() - t0))
+
+    path = os.path.join(directory, 'bench.h5')
+    t0 = time.time()
+    with h5py.File(path, 'w') as f:
+        create_time_dataset(f, 'sync_times', sync_times, np.uint64)
+        create_time_dataset(f, 'arrival_times', times, np.uint64)
+        for i, trace in enumerate(traces):
+            create_time_dataset(f.require_group('exposure_%d' % i), 'trace', trace, np.uint64)
+    timings.append(('write', time.time() - t0))
+    os.remove(path)
+
+    print('%d events (%d records)' % (times.size, records.size))
+    for name, elapsed in timings + [('total', sum(elapsed for name, elapsed in timings))]:
+        print('    %-10s %9.4f s %12.3g events/s' % (name, elapsed, times.size/max(elapsed, 1e-9)))
+
+
+SUITES = {'storage': bench_storage, 'pipeline': bench_pipeline}
+
+def main(suites, sizes):
+    directory = tempfile.mkdtemp()
+    try:
+        for suite in suites:
+            print('--- %s ---' % suite)
+            for n in sizes:
+                SUITES[suite](n, directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    suites = [arg for arg in args if arg in SUITES] or sorted(SUITES)
+    sizes = [int(float(n)) for n in args if n not in SUITES] or [int(1e4), int(1e5), int(1e6), int(1e7)]
+    main(suites, sizes)
@@ -13,41 +13,65 @@ import zmq
 import ctypes as ct
 from ctypes.util import find_library
 import time
+try:
+    import queue
+except ImportError: # python 2.7
+    import Queue as queue
+
+from TH260_processing import decode_t2, decode_t3, count_syncs, to_seconds, RecordBuffer, RecordingFile, Aborted, \
+                              telemetry_dtype
 
 th260=ct.WinDLL(find_library('th260lib64'))
 
-MAXHISTLEN = 5
+MAXHISTLEN = 5 # histogram length code, the histograms have 1024*2**MAXHISTLEN bins
 TTREADMAX = 131072
-T2WRAPAROUND = 33554432
+MODES = {'histogram': 0, 'T2': 2, 'T3': 3} # measurement modes of TH260_Initialize
 
 tacq = 100 #snap time in ms
-
-# Data handling classes
-class TH260_POINT(ct.Structure):
-    _fields_ = [("time", ct.c_uint, 25), ("channel", ct.c_uint, 6), ("special", ct.c_uint, 1)]
-    
-class TH260_DATA(ct.Union):
-    _fields_ = [("allbits", ct.c_uint), ("bits", TH260_POINT)]
+STREAM_QUEUE_SIZE = 256 # max number of FIFO chunks held in memory while streaming
+STREAM_POLL_INTERVAL = 0.005 # in s, wait between two reads of an empty FIFO
+TELEMETRY_INTERVAL = 0.1 # in s, between two telemetry samples during an acquisition, the rate meters are updated every 100 ms
 
 class TH260_Card(object):
     
     def __init__(self, devidx):
         self.devidx=devidx
         #parameters for event dtection
-        self.binning = 0 # meaningful only in T3 mode
-        self.offset = 0 # meaningful only in T3 mode
+        self.mode = None # 'T2', 'T3' or 'histogram', see initialize
+        self.binning = 0 # meaningful only in T3 and histogram mode
+        self.offset = 0 # meaningful only in T3 and histogram mode
         self.tacq = tacq # in ms
         self.syncDivider = 1 # Read the manual carefully
         self.syncTriggerEdge = 1
         self.syncTriggerLevel = 100
         self.inputTriggerEdge = 1
         self.inputTriggerLevel = 100
+        self.channels = [0] # enabled input channels
         
         self.oflcorrection=0
         
+        #parameters for streaming acquisition
+        self.stream_thread = None
+        self.stream_chunks = None
+        self._stop_streaming = threading.Event()
+        self.chunk_consumer = None # called with each chunk of records during the measurement, see start_acquisition
+        self.consume_thread = None
+        self.consume_error = None
+        self._discard_stream = threading.Event()
+        self.fifo_overflow = False
+        self.stop_after_syncs = None
+        self.config_key = None
+        self.abort_event = threading.Event() # interrupts a read of the FIFO, see abort_acquisition
+        self.recording = None # RecordingFile the FIFO records are copied to, see start_recording
+        self.t_start = None # wall clock time of the start of the measurement
+        self.read_stats = {} # durations and counts of the last read, see read_records
+        self.max_chunk_records = 0 # largest FIFO read of the acquisition, a proxy of the FIFO fill level
+        self.max_queued_chunks = 0 # highest number of chunks waiting in self.stream_chunks
+        self.telemetry = [] # samples of the rates, flags and warnings during the acquisition, see sample_telemetry
+        self.last_warnings = 0
+        
         #parameters for data storage
-        self.buffer = (ct.c_uint * TTREADMAX)()
-        self.counts = [(ct.c_uint * MAXHISTLEN)()]
+        self.buffer = RecordBuffer(8*TTREADMAX)
         self.hwSerial = ct.create_string_buffer(b"", 8)
         self.hwPartno = ct.create_string_buffer(b"", 8)
         self.hwVersion = ct.create_string_buffer(b"", 16)
@@ -70,46 +94,99 @@ class TH260_Card(object):
         retCode = th260.TH260_OpenDevice(self.devidx,self.serial_number)
         if retCode != 0 :
             if retCode == -1: # TH260_ERROR_DEVICE_OPEN_FAIL
-                print("  %1d        no device" % self.id)
+                print("  %1d        no device" % self.devidx)
             else :
                 th260.TH260_GetErrorString(self.errorString, ct.c_int(retCode))
                 print("  %1d        %s" % (self.devidx, self.errorString.value.decode("utf8")))
-                raise Exception('device not initialized')
+            raise Exception('device %d not initialized' % self.devidx)
         else : print('serial number is '+str(self.serial_number.value))
         
-        print("Initializing TH260 in T2 mode ...")
-        if th260.TH260_Initialize(self.devidx,2) != 0 : print('issue initializing')
+        self.initialize('T2')
+
+    def initialize(self, mode = 'T2', binning = None, offset = None):
+        """
+        Initializes the card in measurement mode 'T2' or 'T3' (time tagged
+        records) or 'histogram' (the card histograms the photon arrival times
+        after each sync itself), and sets the triggers to their defaults
+        binning, offset : time bin code (bins are 2**binning times the base
+        resolution) and offset in ns, T3 and histogram modes only
+        """
+        if binning is not None : self.binning = binning
+        if offset is not None : self.offset = offset
+        print("Initializing TH260 in "+mode+" mode ...")
+        if th260.TH260_Initialize(self.devidx,MODES[mode]) != 0 : print('issue initializing')
         else : print('... initialized')
+        self.mode = mode
+        self.config_key = None
 
-        if th260.TH260_SetInputEdgeTrg(ct.c_int(0),ct.c_int(0),ct.c_int(self.inputTriggerLevel),ct.c_int(self.inputTriggerEdge)) != 0 : print('issue setting input trigger')
-        else : print('Trigger level set to '+str(self.inputTriggerLevel)+' mV with edge '+str(self.inputTriggerEdge))
+        if th260.TH260_GetNumOfInputChannels(self.devidx,ct.byref(self.numChannels)) != 0 :
+            print('issue getting the number of input channels, assuming 2')
+            self.numChannels.value = 2
+
+        for channel in range(self.numChannels.value):
+            self.set_input_trigger(channel)
         
-        if th260.TH260_SetBinning(ct.c_int(0),ct.c_int(self.binning)) != 0 : print('issue setting binning')
-        else : print('Binning number set to '+str(self.binning))
+        if mode != 'T2':
+            if th260.TH260_SetBinning(self.devidx,ct.c_int(self.binning)) != 0 : print('issue setting binning')
+            else : print('Binning number set to '+str(self.binning))
+            if th260.TH260_SetOffset(self.devidx,ct.c_int(self.offset)) != 0 : print('issue setting offset')
+        if mode == 'histogram':
+            if th260.TH260_SetHistoLen(self.devidx,ct.c_int(MAXHISTLEN),ct.byref(self.histoLen)) != 0 : print('issue setting histogram length')
+            else : print('Histogram length set to '+str(self.histoLen.value))
+
+        # the resolution depends on the binning
+        if th260.TH260_GetResolution(self.devidx,ct.byref(self.resolution)) != 0 :
+            print('issue getting resolution, assuming 250 ps')
+            self.resolution.value = 250. * 2**self.binning if mode != 'T2' else 250.
+        else : print('Resolution is '+str(self.resolution.value)+' ps')
         
-        if th260.TH260_SetSyncEdgeTrg(ct.c_int(0),ct.c_int(self.syncTriggerLevel),ct.c_int(self.syncTriggerEdge)) != 0 : print('issue setting sync trigger')
+        if th260.TH260_SetSyncEdgeTrg(self.devidx,ct.c_int(self.syncTriggerLevel),ct.c_int(self.syncTriggerEdge)) != 0 : print('issue setting sync trigger')
         else : print('Sync trigger level set to '+str(self.syncTriggerLevel)+' mV with edge '+str(self.syncTriggerEdge))
 
+    def set_input_trigger(self, channel = 0, level = None, edge = None) :
+        if level is None : level = self.inputTriggerLevel
+        if edge is None : edge = self.inputTriggerEdge
+        if th260.TH260_SetInputEdgeTrg(self.devidx,ct.c_int(channel),ct.c_int(level),ct.c_int(edge)) != 0 : print('issue setting input trigger')
+        else : print('Trigger level of channel '+str(channel)+' set to '+str(level)+' mV with edge '+str(edge))
+
+    def set_channels(self, channels, trigger_levels = None) :
+        """
+        Selects the input channels used by the following acquisitions, with
+        their trigger levels in mV (card default if None)
+        """
+        self.channels = list(channels)
+        for i, channel in enumerate(self.channels):
+            self.set_input_trigger(channel, None if trigger_levels is None else trigger_levels[i])
+        for channel in range(self.numChannels.value):
+            if channel not in self.channels : self.disable_input_channel(channel)
+
     def enable_input_channel(self, channel = 0) :
         if th260.TH260_SetInputChannelEnable(self.devidx,ct.c_int(channel),ct.c_int(1)) != 0 : print('issue enabling input channel')
     def disable_input_channel(self, channel = 0) :
         if th260.TH260_SetInputChannelEnable(self.devidx,ct.c_int(channel),ct.c_int(0)) != 0 : print('issue disabling input channel')
             
-    def get_cnt_rate (self) :
+    def get_cnt_rate (self, channel = 0) :
         currentCountRate = ct.pointer(ct.c_int(122))
-        if th260.TH260_GetCountRate(self.devidx,0,currentCountRate) != 0 : print('issue getting count rates')
+        if th260.TH260_GetCountRate(self.devidx,channel,currentCountRate) != 0 : print('issue getting count rates')
         return currentCountRate[0]
     
     def snap (self, acqTime = None):
+        """
+        Acquire a trace in live mode, ungated for acqTime ms on the enabled
+        channels, and return its raw T2 records (see read_records). The card
+        is configured again by the next start_acquisition.
+        """
         if acqTime == None : acqTime = self.tacq
-        """ Acquire a trace in live mode and return it as an array of arrival times """        
+        self.abort_event.clear()
         self.configure_acquisition(mode='ctc')
-        if th260.TH260_SetInputChannelEnable(self.devidx,ct.c_int(0),ct.c_int(1)) != 0 : print('issue enabling input channel')
+        for channel in self.channels : self.enable_input_channel(channel)
+        self.config_key = None
         if th260.TH260_StartMeas(self.devidx,acqTime) != 0 : print('issue starting measurement')
         time.sleep(acqTime/1000. + 0.001)
+        records = self.read_records(print_flag=False, live=True)
         self.stop_acquisition()
         
-        return 0 #self.readBuffer()
+        return records
 
     def configure_acquisition (self, mode='gated', startedge = 'rising', stopedge='falling', gate_logic='low'):
         """
@@ -142,24 +219,224 @@ class TH260_Card(object):
             if th260.TH260_SetMeasControl(self.devidx,3,startedge,stopedge) != 0 : print ('issue setting trig mode')
 
 
-    def start_acquisition(self,acqTime=None,gate_logic='low'):
+    def start_acquisition(self,acqTime=None,gate_logic='low',stream=False,config_key=None,stop_after_syncs=None,
+                          channels=None,trigger_levels=None,spill_threshold=None,spill_dir=None,chunk_consumer=None):
         """
         acquire a triggered trace in gated mode
+        if stream is True, the FiFo is drained by a background thread during
+        the whole acquisition (see start_streaming)
+        config_key identifies the settings of the acquisition : when it matches
+        the one of the previous acquisition, and the card was not stopped since,
+        the card is not configured again
+        stop_after_syncs : when streaming, the measurement is stopped as soon as
+        this number of sync events has been read, instead of running for acqTime
+        channels, trigger_levels : input channels to enable and their trigger
+        levels, see set_channels. The previous channels are kept if None.
+        spill_threshold, spill_dir : beyond spill_threshold records, the records
+        are moved to a scratch file in spill_dir (see RecordBuffer)
+        chunk_consumer : when streaming, callable fed with each chunk of raw
+        records as soon as it is read, while the measurement runs (e.g.
+        TH260_processing.IncrementalSegmenter.feed), see _consume_stream
         """
+        self.buffer.spill_threshold, self.buffer.spill_dir = spill_threshold, spill_dir
+        self.chunk_consumer = chunk_consumer
         if acqTime == None : acqTime = self.tacq
-        if th260.TH260_SetInputChannelEnable(self.devidx,ct.c_int(0),ct.c_int(1)) != 0 : print('issue enabling input channel')
-        self.configure_acquisition(mode='gated',gate_logic=gate_logic)
+        self.abort_event.clear()
+        if config_key is None or config_key != self.config_key:
+            if channels is not None : self.set_channels(channels, trigger_levels)
+            for channel in self.channels : self.enable_input_channel(channel)
+            self.configure_acquisition(mode='gated',gate_logic=gate_logic)
+            self.config_key = config_key
+        if self.mode == 'histogram':
+            if th260.TH260_ClearHistMem(self.devidx) != 0 : print('issue clearing histograms')
+            stream = False # no FiFo, the histograms are read at the end with read_histograms
         if th260.TH260_StartMeas(self.devidx,acqTime) != 0 : print('issue starting measurement')
+        self.t_start = time.time()
+        self.max_chunk_records = 0
+        self.max_queued_chunks = 0
+        self.telemetry = []
+        if self.recording is not None : self.recording.start_shot(self.t_start, self.resolution.value, self.mode)
+        if stream : self.start_streaming(stop_after_syncs)
         print('acquiring ...')
         return 0
         
+    def start_streaming(self, stop_after_syncs=None):
+        """
+        Starts a thread polling the FiFo while the measurement runs, so that the
+        hardware FiFo never fills up. The records are pushed in chunks to the
+        bounded queue self.stream_chunks, and moved to self.buffer as they come
+        by a second thread (see _consume_stream), which also hands them to the
+        chunk_consumer if one is set, so that the queue never blocks the reads.
+        If stop_after_syncs is given, the measurement is stopped once that many
+        sync events have been read.
+        """
+        self.stop_streaming()
+        self.fifo_overflow = False
+        self.stop_after_syncs = stop_after_syncs
+        self.stream_chunks = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self._stop_streaming.clear()
+        self._discard_stream.clear()
+        self.stream_thread = threading.Thread(target=self._stream_fifo)
+        self.stream_thread.daemon = True
+        self.stream_thread.start()
+        self.buffer.clear()
+        self.consume_error = None
+        self.consume_thread = threading.Thread(target=self._consume_stream, args=(self.stream_thread, self.chunk_consumer))
+        self.consume_thread.daemon = True
+        self.consume_thread.start()
+
+    def stop_streaming(self):
+        """
+        Asks the streaming thread to empty the FiFo one last time and to exit.
+        Chunks still in the queue are discarded, use readBuffer to keep them.
+        """
+        if self.stream_thread is None : return
+        self._discard_stream.set()
+        self._stop_streaming.set()
+        while self.stream_thread.is_alive():
+            self._drop_chunks()
+            self.stream_thread.join(0.01)
+        self._drop_chunks()
+        self.stream_thread = None
+        if self.consume_thread is not None:
+            self.consume_thread.join()
+            self.consume_thread = None
+
+    def _drop_chunks(self):
+        try:
+            while True : self.stream_chunks.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _stream_fifo(self):
+        """
+        Body of the streaming thread. When asked to stop, it keeps reading until
+        the FiFo is empty so that no record is left on the card. It samples the
+        telemetry every TELEMETRY_INTERVAL, also while it waits for room in the
+        queue of chunks.
+        """
+        nRecords = ct.c_int64()
+        flags = ct.c_int()
+        chunk = np.empty(TTREADMAX, dtype=np.uint32)
+        pchunk = chunk.ctypes.data_as(ct.POINTER(ct.c_uint))
+        n_syncs = 0
+        last_sample = 0
+        while True:
+            stopping = self._stop_streaming.is_set()
+            if time.time() - last_sample >= TELEMETRY_INTERVAL:
+                self.sample_telemetry()
+                last_sample = time.time()
+            th260.TH260_GetFlags(self.devidx, ct.byref(flags))
+            if flags.value & 0x0002 > 0 and not self.fifo_overflow: # 0x0002 is the flag for a full fifo
+                print("FiFo overflow !")
+                self.fifo_overflow = True
+            retcode = th260.TH260_ReadFiFo(self.devidx, pchunk, TTREADMAX, ct.byref(nRecords))
+            if retcode < 0:
+                self.tryfunc(retcode, "ReadFiFo", measRunning = True)
+                break
+            nRec = nRecords.value
+            if nRec > 0:
+                if self.stop_after_syncs is not None:
+                    n_syncs += count_syncs(chunk[:nRec])
+                    if n_syncs >= self.stop_after_syncs:
+                        print('all syncs received, stopping measurement')
+                        if th260.TH260_StopMeas(self.devidx) != 0 : print('issue stopping measmt')
+                        self.stop_after_syncs = None
+                if self.recording is not None : self.recording.write_chunk(time.time() - self.t_start, chunk[:nRec])
+                records = chunk[:nRec].copy()
+                while not self._discard_stream.is_set():
+                    try:
+                        self.stream_chunks.put(records, timeout=STREAM_POLL_INTERVAL) # waits while the queue is full
+                        break
+                    except queue.Full:
+                        if time.time() - last_sample >= TELEMETRY_INTERVAL: # the collector lags, the card still runs
+                            self.sample_telemetry()
+                            last_sample = time.time()
+                self.max_chunk_records = max(self.max_chunk_records, nRec)
+                self.max_queued_chunks = max(self.max_queued_chunks, self.stream_chunks.qsize())
+            elif stopping:
+                break
+            else:
+                time.sleep(STREAM_POLL_INTERVAL)
+
+    def _consume_stream(self, stream_thread, consumer):
+        """
+        Body of the thread collecting the chunks of the streaming thread during
+        the measurement : each chunk is added to self.buffer and handed to the
+        consumer, if any. It exits once the streaming thread is over and its
+        chunks are collected. An error of the consumer is kept in
+        self.consume_error, and raised by readBuffer, the chunks being
+        collected to the end regardless.
+        """
+        while not self._discard_stream.is_set() and not self.abort_event.is_set():
+            try:
+                chunk = self.stream_chunks.get(timeout=STREAM_POLL_INTERVAL)
+            except queue.Empty:
+                if not stream_thread.is_alive() and self.stream_chunks.empty() : break
+                continue
+            self.buffer.append(chunk)
+            if consumer is not None and self.consume_error is None:
+                try:
+                    consumer(chunk)
+                except Exception as e:
+                    print('issue consuming the FiFo records : '+str(e))
+                    self.consume_error = e
+
+
+    def sample_telemetry(self):
+        """
+        Reads the rate meters, the flags and the warnings of the card and
+        appends them to self.telemetry. Called by the thread polling the card
+        during the acquisition (streaming thread, or read_histograms), not by
+        the thread collecting the chunks. The other DLL calls of an abort
+        without a transition are made once the streaming thread is stopped
+        (see TH260_server.TH260Server.abort). A new warning is printed once.
+        """
+        syncRate, countRate, flags, warnings = ct.c_int(), ct.c_int(), ct.c_int(), ct.c_int()
+        if th260.TH260_GetSyncRate(self.devidx, ct.byref(syncRate)) != 0 : print('issue getting sync rate')
+        countRates = []
+        for channel in self.channels:
+            if th260.TH260_GetCountRate(self.devidx, channel, ct.byref(countRate)) != 0 : print('issue getting count rates')
+            countRates.append(countRate.value)
+        if th260.TH260_GetFlags(self.devidx, ct.byref(flags)) != 0 : print('issue getting flags')
+        # the warnings are derived from the rates, read just before
+        if th260.TH260_GetWarnings(self.devidx, ct.byref(warnings)) != 0 : print('issue getting warnings')
+        if warnings.value != 0 and warnings.value != self.last_warnings:
+            if th260.TH260_GetWarningsText(self.devidx, self.warningstext, warnings) == 0:
+                print(self.warningstext.value.decode('utf8'))
+        self.last_warnings = warnings.value
+        self.telemetry.append((time.time() - self.t_start, syncRate.value, countRates, flags.value, warnings.value))
+
+    def read_telemetry(self):
+        """Telemetry samples of the last acquisition, as an array of dtype TH260_processing.telemetry_dtype"""
+        return np.array(self.telemetry, dtype=telemetry_dtype(len(self.channels)))
+
+    def start_recording(self, path):
+        """
+        Copies the raw FIFO records of every following shot to the binary file
+        path, with the time each chunk was read, so that the shots can be
+        replayed without the card by TH260_dev_replay
+        """
+        self.stop_recording()
+        self.recording = RecordingFile(path)
+        print('recording FIFO records to '+path)
+
+    def stop_recording(self):
+        if self.recording is None : return
+        self.recording.close()
+        self.recording = None
 
     def stop_acquisition(self):
+        self.config_key = None # the input channel is disabled, the card has to be configured again
         if th260.TH260_StopMeas(self.devidx) != 0 : print('issue stopping measmt')
-        if th260.TH260_SetInputChannelEnable(self.devidx,ct.c_int(0),ct.c_int(0)) != 0 : print('issue disabling input channel')
+        for channel in self.channels : self.disable_input_channel(channel)
 
     def abort_acquisition(self):
-        self._abort_acquisition = True
+        """
+        Makes a read of the FIFO or of the histograms running in another thread
+        raise Aborted at its next chunk. Cleared by the next start_acquisition.
+        """
+        self.abort_event.set()
 
     def tryfunc(self, retcode, funcName, measRunning = False):
         """
@@ -167,7 +444,7 @@ class TH260_Card(object):
         """
         
         if retcode < 0:
-            th260lib.TH260_GetErrorString(self.errorString, ct.c_int(retcode))
+            th260.TH260_GetErrorString(self.errorString, ct.c_int(retcode))
             print("TH260_%s error %d (%s). Aborted." % (funcName, retcode,\
                   self.errorString.value.decode("utf-8")))
             if measRunning :
@@ -175,17 +452,115 @@ class TH260_Card(object):
             else:
                 self.close()
                 
-    def readBuffer(self, print_flag=True):
+    def readBuffer(self, print_flag=True, integer=False, with_channels=False):
         """
         Reads the FiFo, emptying it in the process
         The max number of TTTR records the buffer can hold is TTREADMAX = 131072
         
-        returns a np array containing the time tagged records
+        returns np arrays containing the sync and photon time tags, in seconds,
+        or as uint64 in units of the card resolution (self.resolution, in ps)
+        if integer is True. If with_channels is True, the input channel of each
+        photon is returned as a third array.
         """
         
-        times = np.array([])
-        sync_times = np.array([])
+        records = self.read_records(print_flag)
+        # Process data
+        t0 = time.time()
+        sync_times, times, channels, self.oflcorrection = decode_t2(records, self.oflcorrection)
+        self.oflcorrection=0
+        
+        if not integer :
+            sync_times, times = to_seconds(sync_times, self.resolution.value), to_seconds(times, self.resolution.value)
+        self.read_stats['decode_time'] = time.time() - t0
+        if with_channels : return sync_times, times, channels
+        return sync_times, times
+    
+    def readT3Buffer(self, print_flag=True):
+        """
+        Reads the FiFo in T3 mode, emptying it in the process
+
+        returns nsync, dtime, channels, marker_nsync, marker_channels as np
+        arrays, see TH260_processing.decode_t3. dtime is in units of the card
+        resolution (self.resolution, in ps)
+        """
+        records = self.read_records(print_flag)
+        t0 = time.time()
+        decoded = decode_t3(records)
+        self.read_stats['decode_time'] = time.time() - t0
+        return decoded[:-1]
+
+    def read_records(self, print_flag=True, live=False):
+        """
+        Empties the FiFo, or collects the records of the streaming thread, in
+        self.buffer and returns a view of the raw records. The duration of the
+        read and the FIFO statistics of the acquisition are kept in
+        self.read_stats.
+        live : the records of a live acquisition (see snap) are not recorded,
+        and no telemetry is sampled
+        """
+        t0 = time.time()
+        if self.stream_thread is not None:
+            self._collect_stream()
+        else:
+            self._drain_fifo(live)
+        self.nRec_total = self.buffer.size
+        self.read_stats = {
+            'drain_time': time.time() - t0,
+            'n_records': self.nRec_total,
+            'max_chunk_records': self.max_chunk_records,
+            'max_queued_chunks': self.max_queued_chunks,
+            'fifo_overflow': self.fifo_overflow,
+        }
+        if print_flag : print("Read " + str(self.nRec_total) + " values from buffer")
+        return self.buffer.view()
+
+    def read_histograms(self, timeout=None):
+        """
+        Waits for the end of a measurement in histogram mode and returns the
+        histograms of the enabled channels, as a dict {channel: uint32 array}
+        timeout : in s, the measurement is stopped if it is not over by then
+        """
+        t0 = time.time()
+        self.read_stats = {}
+        last_sample = 0
+        while True:
+            if self.abort_event.is_set() : raise Aborted('histogram read aborted')
+            if time.time() - last_sample >= TELEMETRY_INTERVAL:
+                self.sample_telemetry()
+                last_sample = time.time()
+            if th260.TH260_CTCStatus(self.devidx,ct.byref(self.ctcstatus)) != 0 : print('issue getting measurement status')
+            if self.ctcstatus.value != 0 : break # the measurement time is over
+            if timeout is not None and time.time() - t0 > timeout:
+                print('measurement not over after '+str(timeout)+' s, stopping it')
+                break
+            time.sleep(STREAM_POLL_INTERVAL)
+        if th260.TH260_StopMeas(self.devidx) != 0 : print('issue stopping measmt')
+        histograms = {}
+        for channel in self.channels:
+            counts = np.zeros(self.histoLen.value, dtype=np.uint32)
+            # clear=0 : the histogram memory is cleared by TH260_ClearHistMem when the next measurement is armed
+            if th260.TH260_GetHistogram(self.devidx,counts.ctypes.data_as(ct.POINTER(ct.c_uint)),ct.c_int(channel),ct.c_int(0)) != 0 :
+                print('issue getting histogram of channel '+str(channel))
+            histograms[channel] = counts
+        return histograms
+
+    def _collect_stream(self):
+        """
+        Stops the streaming thread and waits until _consume_stream has gathered
+        all its chunks in self.buffer
+        """
+        self._stop_streaming.set()
+        while self.consume_thread.is_alive():
+            if self.abort_event.is_set() : raise Aborted('FIFO read aborted') # the thread is stopped by stop_streaming
+            self.consume_thread.join(STREAM_POLL_INTERVAL)
+        self.consume_thread = None
+        self.stream_thread = None
+        if self.consume_error is not None : raise self.consume_error
         
+    def _drain_fifo(self, live=False):
+        # not streamed, a single sample at the end of the acquisition. Not for a live acquisition, the telemetry
+        # belongs to the shots (the samples are timed from the start of the shot)
+        if not live : self.sample_telemetry()
         # Checks for FiFo overflow
         th260.TH260_GetFlags(self.devidx, ct.byref(self.flags), "GetFlags")
         if self.flags.value & 0x0002 > 0: # 0x0002 is the flag for a full fifo
@@ -193,41 +568,23 @@ class TH260_Card(object):
             self.stop_acquisition()
             self.close()
         
-        # Read buffer
-        self.full_buffer = []
-        self.nRec_total = 0
+        # Read buffer, the records are written straight into self.buffer
+        self.buffer.clear()
         while True:
-            self.buffer = (ct.c_uint * TTREADMAX)()
-            self.nRecords = ct.c_int64()
-            # print ('read from buffer')
-            self.tryfunc(th260.TH260_ReadFiFo(self.devidx, ct.byref(self.buffer),
+            if self.abort_event.is_set() : raise Aborted('FIFO read aborted')
+            self.tryfunc(th260.TH260_ReadFiFo(self.devidx, self.buffer.reserve(TTREADMAX),
                                                 TTREADMAX,
                                                 ct.byref(self.nRecords)), "ReadFiFo", measRunning = False)
             nRec = self.nRecords.value
-            self.nRec_total += nRec
-            self.full_buffer.extend(self.buffer[:nRec])
+            if self.recording is not None and nRec > 0 and not live: # the recording only holds the shots
+                self.recording.write_chunk(time.time() - self.t_start, self.buffer.data[self.buffer.filled:self.buffer.filled+nRec])
+            self.buffer.commit(nRec)
+            self.max_chunk_records = max(self.max_chunk_records, nRec)
             
             if nRec == 0: break
         
-        # Process data
-        # if self.nRec_total > 0:
-        if print_flag : print("Read " + str(self.nRec_total) + " values from buffer")
-        for d in self.full_buffer:
-            thd = TH260_DATA(allbits = d)
-            if thd.bits.channel == 0x3F: # 0x3F is 63, meaning an overflow occured, we then add the correction to the time tags
-                self.oflcorrection += T2WRAPAROUND * int(thd.bits.time)
-            elif int(thd.bits.special) == 1 : # a sync event happened at that time
-                sync_times = np.append(sync_times, self.oflcorrection + int(thd.bits.time))
-            else : # no overflow, we simply save that point as data
-                times = np.append(times, self.oflcorrection + int(thd.bits.time))
-        # else:
-            # if print_flag : print("Found an empty buffer")
-        
-        self.oflcorrection=0
-        
-        return sync_times*250e-12, times*250e-12 # resolution is 250ps, ugly implementation but we will unlikely change TH model so why bother
-    
     def close(self):
+        self.stop_recording()
         retCode = th260.TH260_CloseDevice(self.devidx)
         if retCode != 0 : print('issue closing the card') ; print(retCode)
         else : print('card closed')
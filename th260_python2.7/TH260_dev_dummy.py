@@ -28,16 +28,59 @@ import time
 
 # th260=ct.WinDLL(find_library('th260lib64'))
 
-MAXHISTLEN = 5
+from TH260_processing import decode_t2, encode_t2, to_seconds, RecordBuffer, Aborted, telemetry_dtype, FLAG_ACTIVE
+
+MAXHISTLEN = 5 # histogram length code, 1024*2**MAXHISTLEN bins
 TTREADMAX = 131072
-T2WRAPAROUND = 33554432
+TELEMETRY_INTERVAL = 0.1 # in s, as in TH260_dev
 
 tacq = 100 #snap time in ms
 
+# simulated shot : exposures (t, trigger_duration) in s, as written by TH260_new.expose
+DUMMY_EXPOSURES = [(0.01, 0.05), (0.11, 0.05), (0.21, 0.05)]
+DUMMY_COUNT_RATE = 1e4 # photons per s and per channel
+DUMMY_START_DELAY = 0.1 # in s, between the start of the measurement and the start of the shot
+N_PADDING_SYNCS = 20 # sync pulses TH260_new.make_gate adds after the last exposure
+
+
+def sync_pattern(exposures):
+    """
+    Sync times (in s from the start of the shot) of the gate and trigger
+    pattern of TH260_new : a pulse at the start and one at the end of each
+    exposure, then N_PADDING_SYNCS pulses after the last one.
+    exposures : list of (t, trigger_duration), or a table with these columns
+    """
+    exposures = np.array([tuple(exposure)[:2] if not hasattr(exposure, 'dtype') else (exposure['t'], exposure['trigger_duration'])
+                          for exposure in exposures], dtype=float).reshape(-1, 2)
+    starts, durations = exposures[:, 0], exposures[:, 1]
+    tmax = np.max(starts + durations)
+    padding = tmax + 1e-3 + np.arange(1, N_PADDING_SYNCS+1)*5.02e-6
+    return np.concatenate((np.sort(np.concatenate((starts, starts + durations))), padding))
+
+
+def synthetic_t2_records(exposures=DUMMY_EXPOSURES, rate=DUMMY_COUNT_RATE, channels=[0], duration=None,
+                         resolution=250., start_delay=DUMMY_START_DELAY, seed=None):
+    """
+    Raw T2 FiFo records of a simulated shot : syncs following sync_pattern,
+    offset by start_delay, and a Poisson stream of photons at rate (per s)
+    on each of channels, over duration (in s, up to 10 ms after the last sync
+    if None). Overflow records are included as the card writes them.
+    """
+    unit = resolution*1e-12
+    sync_times = sync_pattern(exposures) + start_delay
+    if duration is None : duration = sync_times[-1] + 1e-2
+    rng = np.random.RandomState(seed)
+    n_photons = rng.poisson(rate*len(channels)*duration)
+    times = np.cumsum(rng.exponential(duration/unit/(n_photons + 1), size=n_photons))
+    times = times[times < duration/unit].astype(np.uint64)
+    photon_channels = rng.choice(channels, size=times.size)
+    return encode_t2(np.round(sync_times/unit).astype(np.uint64), times, photon_channels)
+
 class TH260_Card(object):
     
     def __init__(self, devidx):
         self.devidx=devidx
+        self.mode = 'T2'
         #parameters for event dtection
         self.binning = 0 # meaningful only in T3 mode
         self.offset = 0 # meaningful only in T3 mode
@@ -47,12 +90,19 @@ class TH260_Card(object):
         self.syncTriggerLevel = 500
         self.inputTriggerEdge = 1
         self.inputTriggerLevel = 500
+        self.channels = [0]
+        # simulated shot, see synthetic_t2_records
+        self.exposures = DUMMY_EXPOSURES
+        self.count_rate = DUMMY_COUNT_RATE
+        self.acqTime = None
+        self.read_stats = {}
+        self.abort_event = threading.Event()
+        self.chunk_consumer = None
         
         self.oflcorrection=0
         
         #parameters for data storage
-        self.buffer = (ct.c_uint * TTREADMAX)()
-        self.counts = [(ct.c_uint * MAXHISTLEN)()]
+        self.buffer = RecordBuffer(8*TTREADMAX)
         self.hwSerial = ct.create_string_buffer(b"", 8)
         self.hwPartno = ct.create_string_buffer(b"", 8)
         self.hwVersion = ct.create_string_buffer(b"", 16)
@@ -60,7 +110,7 @@ class TH260_Card(object):
         self.errorString = ct.create_string_buffer(b"", 40)
         self.numChannels = ct.c_int()
         self.histoLen = ct.c_int()
-        self.resolution = ct.c_double()
+        self.resolution = ct.c_double(250.)
         self.syncRate = ct.c_int()
         self.countRate = ct.c_int()
         self.flags = ct.c_int()
@@ -68,66 +118,115 @@ class TH260_Card(object):
         self.ctcstatus = ct.c_int()
         self.warnings = ct.c_int()
         self.warningstext = ct.create_string_buffer(b"", 16384)
+
+    def initialize(self, mode = 'T2', binning = None, offset = None):
+        if binning is not None : self.binning = binning
+        if offset is not None : self.offset = offset
+        print("Initializing TH260 in "+mode+" mode ...")
+        self.mode = mode
+        if mode == 'histogram' : self.histoLen.value = 1024 * 2**MAXHISTLEN
+        self.resolution.value = 250. * 2**self.binning if mode != 'T2' else 250.
+
+    def start_acquisition(self, acqTime=None, gate_logic='low', stream=False, config_key=None, stop_after_syncs=None,
+                          channels=None, trigger_levels=None, spill_threshold=None, spill_dir=None, chunk_consumer=None):
+        if channels is not None : self.channels = list(channels)
+        self.buffer.spill_threshold, self.buffer.spill_dir = spill_threshold, spill_dir
+        self.chunk_consumer = chunk_consumer if stream else None
+        self.acqTime = acqTime
+        self.abort_event.clear()
+        print('acquiring ...')
+        return 0
+
+    def simulate_exposures(self, exposures):
+        """Sets the exposure table (see sync_pattern) the syncs of the next shots are simulated from"""
+        self.exposures = exposures
+
+    def stop_acquisition(self):
+        pass
+
+    def abort_acquisition(self):
+        self.abort_event.set()
+
+    def stop_streaming(self):
+        pass
                 
-    def readBuffer(self, print_flag=True):
+    def get_cnt_rate(self, channel=0):
+        return int(self.count_rate)
+
+    def snap(self, acqTime=None):
+        """Simulates a live acquisition of acqTime ms, returns its raw T2 records (see TH260_dev.TH260_Card.snap)"""
+        if acqTime is None : acqTime = self.tacq
+        time.sleep(acqTime/1000.)
+        records = synthetic_t2_records(self.exposures, self.count_rate, self.channels, acqTime/1000., self.resolution.value)
+        self.buffer.clear()
+        self.buffer.append(records)
+        return self.buffer.view()
+
+    def read_telemetry(self):
         """
-        Reads the FiFo, emptying it in the process
-        The max number of TTTR records the buffer can hold is TTREADMAX = 131072
-        
-        returns a np array containing the time tagged records
+        Simulated telemetry of the last acquisition, sampled every
+        TELEMETRY_INTERVAL : the mean sync rate of the shot and the count
+        rate of every channel
         """
-        
-        # times = np.array([])
-        # sync_times = np.array([])
-        
-        # # Checks for FiFo overflow
-        # th260.TH260_GetFlags(self.devidx, ct.byref(self.flags), "GetFlags")
-        # if self.flags.value & 0x0002 > 0: # 0x0002 is the flag for a full fifo
-        #     print("FiFo overflow !")
-        #     self.stop_acquisition()
-        #     self.close()
-        
-        # # Read buffer
-        # self.full_buffer = []
-        # self.nRec_total = 0
-        # while True:
-        #     self.buffer = (ct.c_uint * TTREADMAX)()
-        #     self.nRecords = ct.c_int64()
-        #     # print ('read from buffer')
-        #     self.tryfunc(th260.TH260_ReadFiFo(self.devidx, ct.byref(self.buffer),
-        #                                         TTREADMAX,
-        #                                         ct.byref(self.nRecords)), "ReadFiFo", measRunning = False)
-        #     nRec = self.nRecords.value
-        #     self.nRec_total += nRec
-        #     self.full_buffer.extend(self.buffer[:nRec])
-            
-        #     if nRec == 0: break
-        
-        # # Process data
-        # # if self.nRec_total > 0:
-        # if print_flag : print("Read " + str(self.nRec_total) + " values from buffer")
-        # for d in self.full_buffer:
-        #     thd = TH260_DATA(allbits = d)
-        #     if thd.bits.channel == 0x3F: # 0x3F is 63, meaning an overflow occured, we then add the correction to the time tags
-        #         self.oflcorrection += T2WRAPAROUND * int(thd.bits.time)
-        #     elif int(thd.bits.special) == 1 : # a sync event happened at that time
-        #         sync_times = np.append(sync_times, self.oflcorrection + int(thd.bits.time))
-        #     else : # no overflow, we simply save that point as data
-        #         times = np.append(times, self.oflcorrection + int(thd.bits.time))
-        # # else:
-        #     # if print_flag : print("Found an empty buffer")
-        
-        # self.oflcorrection=0
-        tres = 250e-12
-        ttotal = 0.3/tres
-        gate_times = np.linspace(ttotal+1, ttotal+21, num=20)
-        sync_times = np.concatenate((np.array([tres, 0.1/tres, 0.2/tres, ttotal]), gate_times))
+        duration = self.tacq/1000. if self.acqTime is None else self.acqTime/1000.
+        samples = np.zeros(int(np.ceil(duration/TELEMETRY_INTERVAL)), dtype=telemetry_dtype(len(self.channels)))
+        samples['t'] = np.arange(samples.size) * TELEMETRY_INTERVAL
+        samples['sync_rate'] = len(sync_pattern(self.exposures)) / duration
+        samples['count_rates'] = self.count_rate
+        samples['flags'] = FLAG_ACTIVE
+        return samples
+
+    def read_records(self, print_flag=True):
+        """
+        Simulates reading the FiFo : raw T2 records of the shot are generated
+        (see synthetic_t2_records) and copied in self.buffer by chunks of
+        TTREADMAX as the card is drained, each chunk being handed to the
+        chunk_consumer of start_acquisition. Returns a view of the records.
+        """
+        if self.abort_event.is_set() : raise Aborted('FIFO read aborted')
+        duration = None if self.acqTime is None else self.acqTime/1000.
+        records = synthetic_t2_records(self.exposures, self.count_rate, self.channels, duration, self.resolution.value)
+        t0 = time.time()
+        self.buffer.clear()
+        for i in range(0, records.size, TTREADMAX):
+            self.buffer.append(records[i:i+TTREADMAX])
+            if self.chunk_consumer is not None : self.chunk_consumer(records[i:i+TTREADMAX])
+        self.nRec_total = self.buffer.size
+        if print_flag : print("Read " + str(self.nRec_total) + " values from buffer")
+        self.read_stats = {'drain_time': time.time() - t0, 'n_records': self.nRec_total,
+                           'max_chunk_records': min(records.size, TTREADMAX), 'max_queued_chunks': 0, 'fifo_overflow': False}
+        return self.buffer.view()
 
-        times = np.random.randint(tres, ttotal, size=20)
-        times = np.sort(times)
+    def readBuffer(self, print_flag=True, integer=False, with_channels=False):
+        """
+        Reads the simulated records (see read_records) and decodes them as
+        TH260_dev does
+
+        returns sync_times, times[, channels] as TH260_dev.TH260_Card.readBuffer
+        """
+        records = self.read_records(print_flag)
+        t0 = time.time()
+        sync_times, times, channels, oflcorrection = decode_t2(records)
+        if not integer:
+            sync_times = to_seconds(sync_times, self.resolution.value)
+            times = to_seconds(times, self.resolution.value)
+        self.read_stats['decode_time'] = time.time() - t0
+        if with_channels : return sync_times, times, channels
+        return sync_times, times
+
+    def readT3Buffer(self, print_flag=True):
+        self.read_stats = {}
+        n_syncs = 1000
+        nsync = np.sort(np.random.randint(0, n_syncs, size=200)).astype(np.uint64)
+        dtime = np.random.randint(0, 4000, size=nsync.size).astype(np.uint32)
+        channels = np.random.choice(self.channels, size=nsync.size).astype(np.uint8)
+        return nsync, dtime, channels, np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint8)
+
+    def read_histograms(self, timeout=None):
+        self.read_stats = {}
+        n_bins = self.histoLen.value or 1024 * 2**MAXHISTLEN
+        return dict((channel, np.random.poisson(1., size=n_bins).astype(np.uint32)) for channel in self.channels)
 
-        return sync_times*250e-12, times*250e-12 # resolution is 250ps, ugly implementation but we will unlikely change TH model so why bother
-    
     def close(self):
         print('close card')
     
@@ -0,0 +1,291 @@
+#####################################################################
+# TH260 replay card
+#
+# Stands in for TH260_dev.TH260_Card without the card or the DLL : the
+# shots recorded with TH260_Card.start_recording are fed back to the
+# server, chunk by chunk, with their original timing or faster
+#####################################################################
+
+import time
+import threading
+import ctypes as ct
+import numpy as np
+try:
+    import queue
+except ImportError: # python 2.7
+    import Queue as queue
+
+from TH260_processing import decode_t2, decode_t3, to_seconds, RecordBuffer, index_recording, read_chunks, Aborted, \
+                              telemetry_dtype, FLAG_ACTIVE
+
+TTREADMAX = 131072
+STREAM_QUEUE_SIZE = 256 # as in TH260_dev
+STREAM_POLL_INTERVAL = 0.005
+
+REPLAY_PATH = 'th260_recording.bin' # file written by TH260_dev.TH260_Card.start_recording
+REPLAY_SPEED = 1. # 1 replays the chunks with their original timing, 10 ten times faster, None as fast as possible
+
+tacq = 100 #snap time in ms
+
+class TH260_Card(object):
+
+    def __init__(self, devidx, path=REPLAY_PATH, speed=REPLAY_SPEED):
+        self.devidx = devidx
+        self.path = path
+        self.speed = speed
+        self.shots = index_recording(path) # the records are read from the file one chunk at a time
+        if not self.shots : raise Exception('no shot recorded in '+path)
+        print('replaying %d shots from %s' % (len(self.shots), path))
+        self.shot_index = -1 # shot replayed by the current acquisition, the recording is replayed in a loop
+        self.mode = self.shots[0]['mode']
+        self.binning = 0
+        self.offset = 0
+        self.tacq = tacq
+        self.channels = [0]
+        self.config_key = None
+        self.t_start = None
+        self.abort_event = threading.Event()
+        self.chunk_consumer = None
+        self.stream_thread = None
+        self.consume_thread = None
+        self.consume_error = None
+        self.stream_chunks = None
+        self.stop_after_syncs = None
+        self._stop_streaming = threading.Event()
+        self._discard_stream = threading.Event()
+        self.max_chunk_records = 0
+        self.max_queued_chunks = 0
+        self.telemetry = []
+        self.snap_index = -1 # last chunk replayed by snap
+        self.snap_rates = {}
+        self.read_stats = {}
+        self.oflcorrection = 0
+        self.buffer = RecordBuffer(8*TTREADMAX)
+        self.resolution = ct.c_double(self.shots[0]['resolution'])
+        self.histoLen = ct.c_int()
+
+    def initialize(self, mode = 'T2', binning = None, offset = None):
+        if binning is not None : self.binning = binning
+        if offset is not None : self.offset = offset
+        print("Initializing TH260 in "+mode+" mode ...")
+        self.mode = mode
+
+    def start_acquisition(self, acqTime=None, gate_logic='low', stream=False, config_key=None, stop_after_syncs=None,
+                          channels=None, trigger_levels=None, spill_threshold=None, spill_dir=None, chunk_consumer=None):
+        """
+        Starts replaying the next recorded shot. If stream is True, its chunks
+        are pushed to self.stream_chunks by a background thread as their read
+        time comes, as the streaming thread of TH260_dev does with the FiFo
+        (see start_streaming), otherwise they are replayed by read_records.
+        """
+        self.stop_streaming()
+        if channels is not None : self.channels = list(channels)
+        self.buffer.spill_threshold, self.buffer.spill_dir = spill_threshold, spill_dir
+        self.chunk_consumer = chunk_consumer if stream else None
+        self.shot_index = (self.shot_index + 1) % len(self.shots)
+        shot = self.shots[self.shot_index]
+        if shot['mode'] != self.mode:
+            print('shot %d was recorded in %s mode, not %s' % (self.shot_index, shot['mode'], self.mode))
+        self.resolution.value = shot['resolution']
+        self.abort_event.clear()
+        self.t_start = time.time()
+        self.max_chunk_records = 0
+        self.max_queued_chunks = 0
+        self.telemetry = []
+        if stream and self.mode != 'histogram' : self.start_streaming(stop_after_syncs)
+        print('acquiring ...')
+        return 0
+
+    def start_streaming(self, stop_after_syncs=None):
+        """
+        Starts the thread replaying the chunks of the shot into the bounded
+        queue self.stream_chunks, and the thread moving them to self.buffer as
+        they come, handing them to the chunk_consumer if any (see TH260_dev)
+        """
+        self.stop_after_syncs = stop_after_syncs
+        self.stream_chunks = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self._stop_streaming.clear()
+        self._discard_stream.clear()
+        self.stream_thread = threading.Thread(target=self._stream_replay)
+        self.stream_thread.daemon = True
+        self.stream_thread.start()
+        self.buffer.clear()
+        self.consume_error = None
+        self.consume_thread = threading.Thread(target=self._consume_stream, args=(self.stream_thread, self.chunk_consumer))
+        self.consume_thread.daemon = True
+        self.consume_thread.start()
+
+    def stop_streaming(self):
+        """Stops the replay threads, the chunks not collected yet are discarded"""
+        if self.stream_thread is None : return
+        self._discard_stream.set()
+        self._stop_streaming.set()
+        while self.stream_thread.is_alive():
+            self._drop_chunks()
+            self.stream_thread.join(0.01)
+        self._drop_chunks()
+        self.stream_thread = None
+        if self.consume_thread is not None:
+            self.consume_thread.join()
+            self.consume_thread = None
+
+    def _drop_chunks(self):
+        try:
+            while True : self.stream_chunks.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _replay_chunks(self):
+        """
+        Yields the chunks of the current shot, read from the file one by one,
+        each once the time it was read from the card has passed (divided by
+        self.speed), and samples the telemetry of each one. Stops early when
+        the acquisition is aborted or the stream discarded, or once
+        stop_after_syncs syncs have been replayed, as the card stops then.
+        """
+        shot = self.shots[self.shot_index]
+        previous = 0.
+        n_syncs = 0
+        for t, records in read_chunks(self.path, shot['chunks']):
+            if self.speed:
+                while not self.abort_event.is_set() and not self._discard_stream.is_set():
+                    wait = self.t_start + t/self.speed - time.time()
+                    if wait <= 0 : break
+                    self.abort_event.wait(min(wait, STREAM_POLL_INTERVAL))
+            if self.abort_event.is_set() or self._discard_stream.is_set() : return
+            self.max_chunk_records = max(self.max_chunk_records, records.size)
+            sample = [t, 0., [0.]*len(self.channels), FLAG_ACTIVE, 0]
+            if self.mode == 'T2':
+                # the telemetry itself is not recorded, it is made from the records read since the previous chunk
+                dt = max(t - previous, 1e-3)
+                sync_times, times, channels, oflcorrection = decode_t2(records)
+                sample[1] = sync_times.size / dt
+                sample[2] = [np.count_nonzero(channels == channel) / dt for channel in self.channels]
+                n_syncs += sync_times.size
+            previous = t
+            self.telemetry.append(tuple(sample))
+            yield records
+            if self.stop_after_syncs is not None and n_syncs >= self.stop_after_syncs:
+                print('all syncs received, stopping measurement')
+                return
+
+    def _stream_replay(self):
+        """Body of the streaming thread, see start_streaming"""
+        for records in self._replay_chunks():
+            while not self._discard_stream.is_set():
+                try:
+                    self.stream_chunks.put(records, timeout=STREAM_POLL_INTERVAL) # waits while the queue is full
+                    break
+                except queue.Full:
+                    continue
+            self.max_queued_chunks = max(self.max_queued_chunks, self.stream_chunks.qsize())
+
+    def _consume_stream(self, stream_thread, consumer):
+        """
+        Body of the thread collecting the replayed chunks during the shot, as
+        TH260_dev.TH260_Card._consume_stream
+        """
+        while not self._discard_stream.is_set() and not self.abort_event.is_set():
+            try:
+                chunk = self.stream_chunks.get(timeout=STREAM_POLL_INTERVAL)
+            except queue.Empty:
+                if not stream_thread.is_alive() and self.stream_chunks.empty() : break
+                continue
+            self.buffer.append(chunk)
+            if consumer is not None and self.consume_error is None:
+                try:
+                    consumer(chunk)
+                except Exception as e:
+                    print('issue consuming the FiFo records : '+str(e))
+                    self.consume_error = e
+
+    def _collect_stream(self):
+        """Waits for the end of the replay of the shot and for all its chunks to be gathered in self.buffer"""
+        while self.consume_thread.is_alive():
+            if self.abort_event.is_set() : raise Aborted('FIFO read aborted')
+            self.consume_thread.join(STREAM_POLL_INTERVAL)
+        self.consume_thread = None
+        self.stream_thread = None
+        if self.consume_error is not None : raise self.consume_error
+
+    def stop_acquisition(self):
+        pass
+
+    def abort_acquisition(self):
+        self.abort_event.set()
+
+    def get_cnt_rate(self, channel=0):
+        """Count rate of channel in the last snap"""
+        return self.snap_rates.get(channel, 0)
+
+    def snap(self, acqTime=None):
+        """
+        Replays a live acquisition of acqTime ms : returns the raw records of
+        the next recorded chunk, the shots being replayed in a loop
+        """
+        if acqTime is None : acqTime = self.tacq
+        if self.speed : time.sleep(acqTime/1000./self.speed)
+        chunks = [chunk for shot in self.shots for chunk in shot['chunks']]
+        if not chunks : return np.zeros(0, dtype=np.uint32)
+        self.snap_index = (self.snap_index + 1) % len(chunks)
+        t, records = next(read_chunks(self.path, [chunks[self.snap_index]]))
+        sync_times, times, channels, oflcorrection = decode_t2(records)
+        self.snap_rates = dict((channel, int(np.count_nonzero(channels == channel) / (acqTime/1000.)))
+                               for channel in self.channels)
+        return records
+
+    def read_telemetry(self):
+        """
+        Telemetry of the replayed shot, as the card would have sampled it at
+        each chunk : the sync and count rates of the records read since the
+        previous chunk (T2 shots only, the telemetry itself is not recorded)
+        """
+        return np.array(self.telemetry, dtype=telemetry_dtype(len(self.channels)))
+
+    def read_records(self, print_flag=True):
+        """
+        Collects the chunks of the streaming thread in self.buffer, or replays
+        the chunks of the current shot if it is not streamed, and returns a
+        view of the raw records
+        """
+        t0 = time.time()
+        if self.stream_thread is not None:
+            self._collect_stream()
+        else:
+            self.buffer.clear()
+            for records in self._replay_chunks():
+                self.buffer.append(records)
+            if self.abort_event.is_set() : raise Aborted('FIFO read aborted')
+        self.nRec_total = self.buffer.size
+        self.read_stats = {'drain_time': time.time() - t0, 'n_records': self.nRec_total,
+                           'max_chunk_records': self.max_chunk_records,
+                           'max_queued_chunks': self.max_queued_chunks, 'fifo_overflow': False}
+        if print_flag : print("Read " + str(self.nRec_total) + " values from buffer")
+        return self.buffer.view()
+
+    def readBuffer(self, print_flag=True, integer=False, with_channels=False):
+        records = self.read_records(print_flag)
+        t0 = time.time()
+        sync_times, times, channels, oflcorrection = decode_t2(records)
+        if not integer:
+            sync_times = to_seconds(sync_times, self.resolution.value)
+            times = to_seconds(times, self.resolution.value)
+        self.read_stats['decode_time'] = time.time() - t0
+        if with_channels : return sync_times, times, channels
+        return sync_times, times
+
+    def readT3Buffer(self, print_flag=True):
+        records = self.read_records(print_flag)
+        t0 = time.time()
+        decoded = decode_t3(records)
+        self.read_stats['decode_time'] = time.time() - t0
+        return decoded[:-1]
+
+    def read_histograms(self, timeout=None):
+        self.read_stats = {}
+        print('histograms are not recorded, nothing to replay')
+        return {}
+
+    def close(self):
+        self.stop_streaming()
+        print('close card')
@@ -8,6 +8,7 @@
 #####################################################################
 from __future__ import print_function
 import sys
+import json
 from labscript_devices import labscript_device, BLACS_tab, BLACS_worker
 from labscript import Device, Trigger, TriggerableDevice, set_passed_properties, LabscriptError
 import numpy as np
@@ -22,12 +23,21 @@ class TH260_new(TriggerableDevice):
     allowed_children =[]
     trigger_edge_type = 'rising'
     minimum_recovery_time = 0
+    n_input_channels = 2 # TimeHarp 260 Nano with two inputs, channels are 0 and 1
 
     @set_passed_properties(
         property_names={
             "connection_table_properties": ['devidx'
             ],
-            "device_properties": ["stop_acquisition_timeout"
+            "device_properties": ["stop_acquisition_timeout",
+                                  "storage_layout", "virtual_datasets",
+                                  "timestamp_mode", "storage_encoding",
+                                  "compression", "compression_opts",
+                                  "acquisition_margin", "early_stop",
+                                  "channels", "input_trigger_levels",
+                                  "measurement_mode", "binning", "offset",
+                                  "spill_threshold", "incremental_segmentation",
+                                  "reducers", "feedback_mean_time"
             ],
         }
     )
@@ -40,6 +50,23 @@ class TH260_new(TriggerableDevice):
             devidx,
             trigger_duration=1e-3,
             stop_acquisition_timeout=5.0,
+            storage_layout='groups',
+            virtual_datasets=False,
+            timestamp_mode='seconds',
+            storage_encoding='plain',
+            compression='gzip',
+            compression_opts=None,
+            acquisition_margin=5.0,
+            early_stop=False,
+            channels=None,
+            input_trigger_levels=None,
+            measurement_mode='T2',
+            binning=0,
+            offset=0,
+            spill_threshold=None,
+            incremental_segmentation=False,
+            reducers=None,
+            feedback_mean_time=False,
             **kwargs
         ) :
 
@@ -53,6 +80,54 @@ class TH260_new(TriggerableDevice):
         self.n_exposures = 0
         self.gate_delay=5e-3
         self.code_generated = 0
+        # settings passed to the TH260 server through the shot file
+        if storage_layout not in ['groups', 'ragged']:
+            raise LabscriptError("storage_layout must be 'groups' or 'ragged', not %s" % str(storage_layout))
+        if timestamp_mode not in ['seconds', 'tags']:
+            raise LabscriptError("timestamp_mode must be 'seconds' or 'tags', not %s" % str(timestamp_mode))
+        if storage_encoding not in ['plain', 'delta']:
+            raise LabscriptError("storage_encoding must be 'plain' or 'delta', not %s" % str(storage_encoding))
+        if storage_encoding == 'delta' and timestamp_mode != 'tags':
+            raise LabscriptError("storage_encoding 'delta' requires timestamp_mode 'tags'")
+        if compression not in ['gzip', 'lzf', None]:
+            raise LabscriptError("compression must be 'gzip', 'lzf' or None, not %s" % str(compression))
+        if channels is None : channels = [0]
+        if len(channels) == 0 or not all(0 <= channel < self.n_input_channels for channel in channels):
+            raise LabscriptError('channels must be a non empty list of inputs between 0 and %d, not %s' % (self.n_input_channels - 1, str(channels)))
+        if len(set(channels)) != len(channels):
+            raise LabscriptError('channels must not be repeated, not %s' % str(channels))
+        if input_trigger_levels is not None and len(input_trigger_levels) != len(channels):
+            raise LabscriptError('input_trigger_levels needs one level per channel')
+        if measurement_mode not in ['T2', 'T3', 'histogram']:
+            raise LabscriptError("measurement_mode must be 'T2', 'T3' or 'histogram', not %s" % str(measurement_mode))
+        if not 0 <= binning <= 24:
+            raise LabscriptError('binning must be between 0 and 24, not %s' % str(binning))
+        if spill_threshold is not None and not spill_threshold > 0:
+            raise LabscriptError('spill_threshold must be a positive number of records or None, not %s' % str(spill_threshold))
+        for reducer in reducers or []:
+            if isinstance(reducer, (list, tuple)) and not (len(reducer) == 2 and isinstance(reducer[1], dict)):
+                raise LabscriptError('reducers must be names or [name, {keyword arguments}], not %s' % str(reducer))
+        if feedback_mean_time not in [True, False]:
+            raise LabscriptError('feedback_mean_time must be True or False, not %s' % str(feedback_mean_time))
+        self.server_config = {
+            'storage_layout': storage_layout,
+            'virtual_datasets': bool(virtual_datasets),
+            'timestamp_mode': timestamp_mode,
+            'storage_encoding': storage_encoding,
+            'compression': compression,
+            'compression_opts': compression_opts,
+            'acquisition_margin': acquisition_margin,
+            'early_stop': bool(early_stop),
+            'channels': [int(channel) for channel in channels],
+            'input_trigger_levels': None if input_trigger_levels is None else [int(level) for level in input_trigger_levels],
+            'measurement_mode': measurement_mode,
+            'binning': int(binning),
+            'offset': int(offset),
+            'spill_threshold': None if spill_threshold is None else int(spill_threshold),
+            'incremental_segmentation': bool(incremental_segmentation),
+            'reducers': None if reducers is None else [list(reducer) if isinstance(reducer, (list, tuple)) else reducer for reducer in reducers],
+            'feedback_mean_time': bool(feedback_mean_time),
+        }
         
         if None in [parent_device, connection] and not parentless:
             raise LabscriptError('No parent specified. If this device does not require a parent, set parentless=True')
@@ -146,7 +221,12 @@ class TH260_new(TriggerableDevice):
         triggers.append([t, duration])
                 
     
-    def expose(self, t, name, frametype, trigger_duration=None):
+    def expose(self, t, name, frametype, trigger_duration=None, g2_bin_width=None, g2_max_lag=None):
+        """
+        Records a trace of duration trigger_duration starting at t. If g2_bin_width
+        and g2_max_lag (in s) are given, the server also stores the photon
+        correlation histograms of the trace, between every pair of channels.
+        """
         if isinstance(t, str) and isinstance(name, (int, float)):
             msg = """expose() takes `t` as the first argument and `name` as the second
                 argument, but was called with a string as the first argument and a
@@ -163,13 +243,19 @@ class TH260_new(TriggerableDevice):
         if not trigger_duration > 0:
             msg = "trigger_duration must be > 0, not %s" % str(trigger_duration)
             raise ValueError(msg)
+        if (g2_bin_width is None) != (g2_max_lag is None):
+            raise LabscriptError('g2_bin_width and g2_max_lag have to be given together')
+        if g2_bin_width is None:
+            g2_bin_width, g2_max_lag = 0., 0. # no correlation for this exposure
+        elif not 0 < g2_bin_width <= g2_max_lag:
+            raise ValueError('g2 requires 0 < g2_bin_width <= g2_max_lag')
 
         self.trigger(t,2.51e-6)
         self.trigger(t+trigger_duration,2.51e-6)
 
         # print('banana')
 
-        self.exposures.append((t, name, frametype, trigger_duration))
+        self.exposures.append((t, name, frametype, trigger_duration, g2_bin_width, g2_max_lag))
 
         if self.n_exposures == 0 :
             self.tmin=t
@@ -197,9 +283,12 @@ class TH260_new(TriggerableDevice):
                 ('name', vlenstr),
                 ('frametype',vlenstr),
                 ('trigger_duration', float),
+                ('g2_bin_width', float),
+                ('g2_max_lag', float),
             ]
             data = np.array(self.exposures, dtype=table_dtypes)
             group = self.init_device_group(hdf5_file)
+            group.attrs['server_config'] = json.dumps(self.server_config)
             if self.exposures:
                 group.create_dataset('EXPOSURES', data=data)
             self.code_generated = 1
@@ -210,6 +299,7 @@ import json
 import ast
 import numpy as np
 import pyqtgraph as pg
+import zmq
 
 from blacs.tab_base_classes import Worker, define_state
 from blacs.tab_base_classes import MODE_MANUAL, MODE_TRANSITION_TO_BUFFERED, MODE_TRANSITION_TO_MANUAL, MODE_BUFFERED  
@@ -218,6 +308,11 @@ from blacs.device_base_class import DeviceTab
 import labscript_utils.properties
 
 from qtutils import UiLoader
+from qtutils.qt.QtCore import QTimer
+from qtutils.qt.QtWidgets import QCheckBox
+
+LIVE_PORT_OFFSET = 2000 # port of the live view of the server, relative to its port, see TH260_server.LIVE_PORT_OFFSET
+LIVE_REFRESH_INTERVAL = 100 # in ms, the plots of the live view are redrawn at most this often
 
 @BLACS_tab
 class TH260Tab(DeviceTab):
@@ -237,6 +332,25 @@ class TH260Tab(DeviceTab):
         self.ui.use_zmq_checkBox.toggled.connect(self.update_settings_and_check_connectivity)
         self.ui.check_connectivity_pushButton.clicked.connect(self.update_settings_and_check_connectivity)
         
+        # live view of the manual mode : arrival time histograms and count rates published by the server
+        self.live_checkBox = QCheckBox('Live view')
+        self.histogram_plot = pg.PlotWidget(title='Arrival times after the sync')
+        self.histogram_plot.setLabel('bottom', 'delay', units='s')
+        self.histogram_plot.addLegend()
+        self.rate_plot = pg.PlotWidget(title='Count rates')
+        self.rate_plot.setLabel('bottom', 'time', units='s')
+        self.rate_plot.setLabel('left', 'count rate', units='Hz')
+        self.rate_plot.addLegend()
+        layout.addWidget(self.live_checkBox)
+        layout.addWidget(self.histogram_plot)
+        layout.addWidget(self.rate_plot)
+        self.histogram_curves = {}
+        self.rate_curves = {}
+        self.live_sock = None
+        self.live_timer = QTimer()
+        self.live_timer.timeout.connect(self.update_live_view)
+        self.live_checkBox.toggled.connect(self.toggle_live)
+
     def get_save_data(self):
         return {'host': str(self.ui.host_lineEdit.text()), 'use_zmq': self.ui.use_zmq_checkBox.isChecked()}
     
@@ -271,6 +385,45 @@ class TH260Tab(DeviceTab):
         responding = yield(self.queue_work(self.primary_worker, 'update_settings_and_check_connectivity', **kwargs))
         self.update_responding_indicator(responding)
         
+    def toggle_live(self, enabled):
+        """Subscribes to the live view of the server and turns it on, or the other way round"""
+        if self.live_sock is not None:
+            self.live_timer.stop()
+            self.live_sock.close()
+            self.live_sock = None
+        if enabled:
+            port = int(self.ui.port_label.text()) + LIVE_PORT_OFFSET
+            self.live_sock = zmq.Context.instance().socket(zmq.SUB)
+            self.live_sock.setsockopt(zmq.CONFLATE, 1) # only the last frame is kept, the plots never lag behind
+            self.live_sock.setsockopt(zmq.SUBSCRIBE, b'')
+            self.live_sock.connect('tcp://%s:%d' % (str(self.ui.host_lineEdit.text()), port))
+            self.live_timer.start(LIVE_REFRESH_INTERVAL)
+        self.set_live(enabled)
+
+    @define_state(MODE_MANUAL, queue_state_indefinitely=True)
+    def set_live(self, enabled):
+        yield(self.queue_work(self.primary_worker, 'set_live', enabled))
+
+    def update_live_view(self):
+        """Plots the last frame of the live view (see TH260_server.TH260Server.live_loop), if a new one came"""
+        try:
+            frame = json.loads(self.live_sock.recv(zmq.NOBLOCK).decode('utf8'))
+        except zmq.Again:
+            return
+        colors = ['y', 'c', 'm', 'g', 'r', 'b']
+        delays = np.arange(len(frame['histograms'][0]) if frame['histograms'] else 0) * frame['bin_width']
+        rate_times = np.array(frame['rate_times']) - frame['time']
+        for i, channel in enumerate(frame['channels']):
+            if channel not in self.histogram_curves:
+                pen = colors[len(self.histogram_curves) % len(colors)]
+                self.histogram_curves[channel] = self.histogram_plot.plot(pen=pen, name='ch%d' % channel)
+                self.rate_curves[channel] = self.rate_plot.plot(pen=pen, name='ch%d' % channel)
+            self.histogram_curves[channel].setData(delays, frame['histograms'][i])
+            self.rate_curves[channel].setData(rate_times, frame['rates'][i])
+        self.rate_plot.setTitle('Count rates : ' + ', '.join('ch%d %.3g Hz' % (channel, rate) for channel, rate in
+                                                             zip(frame['channels'], frame['count_rates'])) +
+                                ', sync %.3g Hz' % frame['sync_rate'])
+
     def update_responding_indicator(self, responding):
         self.ui.saying_hello.setVisible(False)
         if responding:
@@ -281,6 +434,88 @@ class TH260Tab(DeviceTab):
             self.ui.is_not_responding.setVisible(True)
 
 
+class ServerConnection(object):
+    """
+    Persistent connection of the BLACS worker to the TH260 server, created once
+    and reused for every transition.
+
+    With zmq, requests go through a single REQ socket. With plain sockets,
+    messages are framed by '\r\n' and read through a buffer, so that a reply
+    split over several packets, or two replies in one packet, are handled.
+    After a timeout or a broken link the connection is dropped, and the next
+    request reconnects.
+    """
+
+    def __init__(self, host, port, use_zmq):
+        assert port, 'No port number supplied.'
+        assert host, 'No hostname supplied.'
+        assert str(int(port)) == str(port), 'Port must be an integer.'
+        self.host = host
+        self.port = int(port)
+        self.use_zmq = use_zmq
+        self.sock = None
+        self._received = b''
+
+    def connect(self):
+        if self.use_zmq:
+            self.sock = zmq.Context.instance().socket(zmq.REQ)
+            self.sock.setsockopt(zmq.LINGER, 0)
+            self.sock.connect('tcp://%s:%d' % (self.host, self.port))
+        else:
+            self.sock = socket.create_connection((self.host, self.port), timeout=10)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._received = b''
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self._received = b''
+
+    def request(self, message, timeout=120):
+        """Sends a message and returns the reply of the server"""
+        if self.sock is None:
+            self.connect()
+        try:
+            if self.use_zmq:
+                self.sock.send_string(message)
+            else:
+                try:
+                    self.sock.sendall(message.encode('utf8') + b'\r\n')
+                except socket.error:
+                    # the server closed the link since the last request, reconnect once
+                    self.connect()
+                    self.sock.sendall(message.encode('utf8') + b'\r\n')
+            return self.receive(timeout)
+        except Exception:
+            self.close()
+            raise
+
+    def follow_up(self, timeout=120):
+        """Returns the second reply of a two step transition ('ok' then 'done')"""
+        if self.use_zmq:
+            return self.request('', timeout) # REQ sockets have to send before receiving again
+        try:
+            return self.receive(timeout)
+        except Exception:
+            self.close()
+            raise
+
+    def receive(self, timeout):
+        if self.use_zmq:
+            if not self.sock.poll(timeout*1000):
+                raise Exception('no response from server within %s s' % str(timeout))
+            return self.sock.recv_string()
+        self.sock.settimeout(timeout)
+        while b'\r\n' not in self._received:
+            data = self.sock.recv(4096)
+            if not data:
+                raise Exception('connection closed by server')
+            self._received += data
+        message, self._received = self._received.split(b'\r\n', 1)
+        return message.decode('utf8')
+
+
 @BLACS_worker
 class TH260ServerWorker(Worker):
     def init(self):#, port, host, use_zmq):
@@ -289,92 +524,80 @@ class TH260ServerWorker(Worker):
 #        self.use_zmq = use_zmq
         global socket; import socket
         global zmq; import zmq
-        global zprocess; import zprocess
         global shared_drive; import labscript_utils.shared_drive as shared_drive
+        global base64; import base64
         
         self.host = ''
         self.use_zmq = False
+        self.connection = None
+        self.feedback = None # counts of the last shot, sent back by the server with 'done'
         
     def update_settings_and_check_connectivity(self, host, use_zmq):
         self.host = host
         self.use_zmq = use_zmq
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
         if not self.host:
             return False
-        if not self.use_zmq:
-            return self.initialise_sockets(self.host, self.port)
-        else:
-            response = zprocess.zmq_get_raw(self.port, self.host, data='hello')
-            if response == 'hello':
-                return True
-            else:
-                raise Exception('invalid response from server: ' + str(response))
-                
-    def initialise_sockets(self, host, port):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        assert port, 'No port number supplied.'
-        assert host, 'No hostname supplied.'
-        assert str(int(port)) == port, 'Port must be an integer.'
-        s.settimeout(10)
-        s.connect((host, int(port)))
-        s.send('hello\r\n')
-        response = s.recv(1024)
-        s.close()
-        if 'hello' in response:
+        self.connection = ServerConnection(self.host, self.port, self.use_zmq)
+        response = self.connection.request('hello', timeout=10)
+        if response == 'hello':
             return True
         else:
-            raise Exception('invalid response from server: ' + response)
-    
-    def transition_to_buffered(self, device_name, h5file, initial_values, fresh):
-        h5file = shared_drive.path_to_agnostic(h5file)
-        if not self.use_zmq:
-            return self.transition_to_buffered_sockets(h5file,self.host, self.port)
-        response = zprocess.zmq_get_raw(self.port, self.host, data=h5file)
-        if response != 'ok':
             raise Exception('invalid response from server: ' + str(response))
-        response = zprocess.zmq_get_raw(self.port, self.host, timeout = 120)
-        if response != 'done':
+
+    def check_response(self, response, expected):
+        if response not in expected:
             raise Exception('invalid response from server: ' + str(response))
-        return {} # indicates final values of buffered run, we have none
-        
-    def transition_to_buffered_sockets(self, h5file, host, port):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(120)
-        s.connect((host, int(port)))
-        s.send('%s\r\n'%h5file)
-        response = s.recv(1024)
-        if not 'ok' in response:
-            s.close()
-            raise Exception(response)
-        response = s.recv(1024)
-        if not 'done' in response:
-            s.close()
-            raise Exception(response)
+    
+    def arm_request(self, device_name, h5file):
+        """
+        Builds the 'arm' request of a shot : the exposure table and the server
+        config are sent in-band with the h5 path, so that the server does not
+        have to open the shot file on the shared drive to arm the card.
+        The table is sent as the raw bytes of a fixed width numpy array, the
+        strings (exposure names and frametypes) encoded in UTF-8.
+        """
+        with h5py.File(h5file, 'r') as f:
+            group = f['devices'][device_name]
+            exposures = group['EXPOSURES'][:] if 'EXPOSURES' in group else np.zeros(0, dtype=[('t', float)])
+            config = json.loads(group.attrs['server_config']) if 'server_config' in group.attrs else {}
+        dtype = []
+        strings = {}
+        for name in exposures.dtype.names:
+            if exposures.dtype[name].kind == 'O': # variable length strings, sized once encoded
+                strings[name] = [x if isinstance(x, bytes) else x.encode('utf8') for x in exposures[name]]
+                width = max([len(x) for x in strings[name]] + [1])
+                dtype.append((name, 'S%d' % width))
+            else:
+                dtype.append((name, exposures.dtype[name].str))
+        table = np.zeros(len(exposures), dtype=dtype)
+        for name in exposures.dtype.names:
+            table[name] = strings[name] if name in strings else exposures[name]
+        header = {
+            'h5_filepath': shared_drive.path_to_agnostic(h5file),
+            'config': config,
+            'dtype': dtype,
+            'exposures': base64.b64encode(table.tobytes()).decode('ascii'),
+        }
+        return 'arm ' + json.dumps(header)
+    
+    def transition_to_buffered(self, device_name, h5file, initial_values, fresh):
+        request = self.arm_request(device_name, h5file)
+        self.check_response(self.connection.request(request, timeout=120), ['ok'])
+        self.check_response(self.connection.follow_up(timeout=120), ['done'])
         return {} # indicates final values of buffered run, we have none
         
     def transition_to_manual(self):
-        if not self.use_zmq:
-            return self.transition_to_manual_sockets(self.host, self.port)
-        response = zprocess.zmq_get_raw(self.port, self.host, 'done')
-        if response != 'ok':
-            raise Exception('invalid response from server: ' + str(response))
-        response = zprocess.zmq_get_raw(self.port, self.host, timeout = 60)
-        if response != 'done':
-            raise Exception('invalid response from server: ' + str(response))
-        return True # indicates success
-        
-    def transition_to_manual_sockets(self, host, port):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(120)
-        s.connect((host, int(port)))
-        s.send('done\r\n')
-        response = s.recv(1024)
-        if response != 'ok\r\n':
-            s.close()
-            raise Exception(response)
-        response = s.recv(1024)
-        if not 'done' in response:
-            s.close()
-            raise Exception(response)
+        self.check_response(self.connection.request('done', timeout=120), ['ok'])
+        response = self.connection.follow_up(timeout=120)
+        self.check_response(response.split(' ', 1)[0], ['done'])
+        # 'done {...}' carries the counts of each trace of a T2 shot, see TH260_server.ShotWriter.counts_feedback
+        self.feedback = json.loads(response.split(' ', 1)[1]) if ' ' in response else None
+        if self.feedback is not None:
+            print('counts : ' + ', '.join('%s %d' % (name, count) for name, count in
+                                         zip(self.feedback['names'], self.feedback['counts'])))
         return True # indicates success
         
     def abort_buffered(self):
@@ -384,26 +607,17 @@ class TH260ServerWorker(Worker):
         return self.abort()
     
     def abort(self):
-        if not self.use_zmq:
-            return self.abort_sockets(self.host, self.port)
-        response = zprocess.zmq_get_raw(self.port, self.host, 'abort')
-        if response != 'done':
-            raise Exception('invalid response from server: ' + str(response))
-        return True # indicates success 
-        
-    def abort_sockets(self, host, port):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(120)
-        s.connect((host, int(port)))
-        s.send('abort\r\n')
-        response = s.recv(1024)
-        if not 'done' in response:
-            s.close()
-            raise Exception(response)
+        self.check_response(self.connection.request('abort', timeout=120), ['ok', 'done'])
         return True # indicates success 
     
     def program_manual(self, values):
         return {}
+
+    def set_live(self, enabled):
+        self.check_response(self.connection.request('live start' if enabled else 'live stop', timeout=10), ['ok'])
+        return True
     
     def shutdown(self):
-        return
\ No newline at end of file
+        if self.connection is not None:
+            self.connection.close()
+        return
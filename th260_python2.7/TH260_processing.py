@@ -0,0 +1,990 @@
+#####################################################################
+# TH260 data processing
+#
+# Hardware independent helpers shared by TH260_dev, TH260_dev_dummy
+# and TH260_server
+#####################################################################
+
+import os
+import time
+import struct
+import collections
+import tempfile
+import ctypes as ct
+from contextlib import contextmanager
+import numpy as np
+
+T2WRAPAROUND = 33554432
+T3WRAPAROUND = 1024
+
+# T2 record layout (see TH260lib manual, section on TTTR records)
+T2_TIME_MASK = 0x01FFFFFF # bits 0-24
+T2_CHANNEL_SHIFT = 25
+T2_CHANNEL_MASK = 0x3F # bits 25-30
+T2_SPECIAL_SHIFT = 31 # bit 31
+T2_OVERFLOW_CHANNEL = 0x3F
+
+# T3 record layout, the channel and special bits are as in T2
+T3_NSYNC_MASK = 0x3FF # bits 0-9, sync count since the last overflow
+T3_DTIME_SHIFT = 10
+T3_DTIME_MASK = 0x7FFF # bits 10-24, delay after the last sync in units of the resolution
+
+
+class Aborted(Exception):
+    """Raised by the cards and TH260_server.ShotWriter to interrupt the read or the saving of an aborted shot"""
+
+
+def decode_t2(records, oflcorrection=0):
+    """
+    Decodes an array of raw T2 FIFO records in a single vectorized pass.
+
+    records : array like of uint32 records as read from TH260_ReadFiFo
+    oflcorrection : overflow correction (in tag units) accumulated by previous
+        chunks of the same acquisition, so that a FIFO drained in several reads
+        can be decoded chunk by chunk
+
+    returns sync_times, times, channels, oflcorrection
+        sync_times and times are uint64 arrays of time tags (in units of the
+        card resolution), channels holds the input channel of each photon of
+        times, oflcorrection is the correction to pass along with the next chunk
+    """
+    records = np.asarray(records, dtype=np.uint32)
+
+    tags = (records & T2_TIME_MASK).astype(np.uint64)
+    channel = (records >> T2_CHANNEL_SHIFT) & T2_CHANNEL_MASK
+    special = (records >> T2_SPECIAL_SHIFT).astype(bool)
+
+    # 0x3F is 63, meaning an overflow occured, the time field then holds the number of wraparounds
+    overflow = special & (channel == T2_OVERFLOW_CHANNEL)
+    wraps = np.where(overflow, tags, 0)
+    correction = np.cumsum(wraps, dtype=np.uint64)
+    correction *= np.uint64(T2WRAPAROUND)
+    correction += np.uint64(oflcorrection)
+
+    tags += correction
+    sync_times = tags[special & ~overflow] # a sync event happened at that time
+    times = tags[~special]
+    channels = channel[~special].astype(np.uint8)
+
+    if correction.size : oflcorrection = int(correction[-1])
+    return sync_times, times, channels, oflcorrection
+
+
+def encode_t2(sync_times, times, channels=None):
+    """
+    Inverse of decode_t2 : builds the raw T2 FIFO records of sorted sync and
+    photon time tags, with an overflow record before each event that follows
+    a wraparound, as the card would write them. Used to simulate the card.
+
+    channels : input channel of each photon, 0 for all if None
+
+    returns a uint32 array of records
+    """
+    sync_times = np.asarray(sync_times, dtype=np.uint64)
+    times = np.asarray(times, dtype=np.uint64)
+    if channels is None : channels = np.zeros(times.size, dtype=np.uint32)
+    words = np.concatenate((np.full(sync_times.size, 1 << T2_SPECIAL_SHIFT, dtype=np.uint32),
+                            np.asarray(channels, dtype=np.uint32) << T2_CHANNEL_SHIFT))
+    tags = np.concatenate((sync_times, times))
+    order = np.argsort(tags, kind='mergesort')
+    tags, words = tags[order], words[order]
+
+    wraps = tags // np.uint64(T2WRAPAROUND)
+    jumps = np.diff(wraps, prepend=np.uint64(0)).astype(np.uint32)
+    records = words | (tags % np.uint64(T2WRAPAROUND)).astype(np.uint32)
+    where = np.flatnonzero(jumps)
+    overflows = np.uint32((1 << T2_SPECIAL_SHIFT) | (T2_OVERFLOW_CHANNEL << T2_CHANNEL_SHIFT)) | jumps[where]
+    return np.insert(records, where, overflows)
+
+
+SPILL_CHUNK = 1 << 22 # records decoded, or times written, at once in spill mode
+
+
+def decode_t2_to_files(records, directory, resolution=None, channels=None, chunk_size=SPILL_CHUNK):
+    """
+    Decodes raw T2 records chunk by chunk (see decode_t2) into files of
+    directory, so that the memory used stays bounded whatever the number of
+    records, e.g. records spilled to disk by RecordBuffer.
+
+    resolution : if given, the times are converted to s (see to_seconds)
+    channels : if several channels are given, the times of each channel are
+        also written in a file of their own, as demultiplex would return them
+
+    returns sync_times, times, photon_channels, channel_times : sync_times is
+        in memory, times and photon_channels are read only memory maps of the
+        files, channel_times is a dict {channel: memory map} or None
+    """
+    dtype = np.uint64 if resolution is None else np.float64
+    names = ['times', 'channels'] + ['times_ch%d' % channel for channel in (channels or [])]
+    files = dict((name, open(os.path.join(directory, name + '.bin'), 'wb')) for name in names)
+    sizes = dict((name, 0) for name in names)
+    sync_chunks = []
+    oflcorrection = 0
+    try:
+        for start in range(0, len(records), chunk_size):
+            sync_times, times, photon_channels, oflcorrection = decode_t2(records[start:start+chunk_size], oflcorrection)
+            if resolution is not None:
+                sync_times, times = to_seconds(sync_times, resolution), to_seconds(times, resolution)
+            sync_chunks.append(sync_times)
+            outputs = {'times': times, 'channels': photon_channels}
+            for channel in channels or []:
+                outputs['times_ch%d' % channel] = times[photon_channels == channel]
+            for name, data in outputs.items():
+                files[name].write(data.tobytes())
+                sizes[name] += data.size
+    finally:
+        for f in files.values() : f.close()
+
+    def mapped(name, dtype):
+        if sizes[name] == 0 : return np.zeros(0, dtype=dtype) # an empty file cannot be mapped
+        return np.memmap(os.path.join(directory, name + '.bin'), dtype=dtype, mode='r', shape=(sizes[name],))
+
+    sync_times = np.concatenate(sync_chunks) if sync_chunks else np.zeros(0, dtype=dtype)
+    channel_times = None
+    if channels:
+        channel_times = dict((channel, mapped('times_ch%d' % channel, dtype)) for channel in channels)
+    return sync_times, mapped('times', dtype), mapped('channels', np.uint8), channel_times
+
+
+def decode_t3(records, oflcorrection=0):
+    """
+    Decodes an array of raw T3 FIFO records in a single vectorized pass.
+
+    oflcorrection : overflow correction (in syncs) of the previous chunks, as
+        in decode_t2
+
+    returns nsync, dtime, channels, marker_nsync, marker_channels, oflcorrection
+        for each photon, nsync is the uint64 index of the last sync, dtime the
+        delay after it in units of the resolution and channels the input
+        channel. marker_nsync and marker_channels are the sync index and
+        channel of each external marker.
+    """
+    records = np.asarray(records, dtype=np.uint32)
+
+    nsync = (records & T3_NSYNC_MASK).astype(np.uint64)
+    dtime = (records >> T3_DTIME_SHIFT) & T3_DTIME_MASK
+    channel = (records >> T2_CHANNEL_SHIFT) & T2_CHANNEL_MASK
+    special = (records >> T2_SPECIAL_SHIFT).astype(bool)
+
+    overflow = special & (channel == T2_OVERFLOW_CHANNEL)
+    wraps = np.where(overflow, np.maximum(nsync, 1), 0) # an nsync of 0 means a single overflow (old firmware)
+    correction = np.cumsum(wraps, dtype=np.uint64)
+    correction *= np.uint64(T3WRAPAROUND)
+    correction += np.uint64(oflcorrection)
+
+    nsync += correction
+    photons = ~special
+    markers = special & ~overflow
+    if correction.size : oflcorrection = int(correction[-1])
+    return (nsync[photons], dtime[photons], channel[photons].astype(np.uint8),
+            nsync[markers], channel[markers].astype(np.uint8), oflcorrection)
+
+
+def demultiplex(times, channels, wanted):
+    """
+    Splits photon times by input channel with a single stable sort
+
+    returns a dict {channel: times of that channel}, for each channel in wanted
+    """
+    if len(wanted) == 1:
+        return {wanted[0]: times[channels == wanted[0]]}
+    order = np.argsort(channels, kind='mergesort') # stable, times stay sorted within a channel
+    times = times[order]
+    channels = channels[order]
+    bounds = np.searchsorted(channels, [(c, c+1) for c in wanted])
+    return dict((c, times[start:stop]) for c, (start, stop) in zip(wanted, bounds))
+
+
+def count_syncs(records):
+    """Counts the sync records in an array of raw T2 records, without decoding them"""
+    records = np.asarray(records, dtype=np.uint32)
+    special = (records >> T2_SPECIAL_SHIFT).astype(bool)
+    overflow = ((records >> T2_CHANNEL_SHIFT) & T2_CHANNEL_MASK) == T2_OVERFLOW_CHANNEL
+    return int(np.count_nonzero(special & ~overflow))
+
+
+CORRELATION_BLOCK = 1 << 22 # photons of times_a, and pairs of photons, handled at once by correlate, bounds its memory
+
+
+def correlate(times_a, times_b, bin_width, max_lag, auto=False):
+    """
+    Histogram of the delays times_b - times_a up to +-max_lag, for the
+    intensity correlation (g2) of two photon streams, or of one stream with
+    itself if auto is True (the zero delay of each photon with itself is then
+    left out).
+
+    The streams must be sorted, and may be memory mapped (spilled shots) :
+    times_a is read CORRELATION_BLOCK photons at a time, with the part of
+    times_b within max_lag of them. The delays within max_lag of each photon
+    are found with searchsorted, so the cost scales as n log n plus the
+    number of pairs within max_lag, not as n_a*n_b. The pairs of a block are
+    numbered one photon of times_a after the other and expanded
+    CORRELATION_BLOCK at a time, so the memory used does not depend on the
+    length of the streams, the count rate nor max_lag.
+
+    returns hist, edges : counts per bin and the 2*n+1 bin edges
+    """
+    n_bins = int(np.ceil(max_lag / float(bin_width)))
+    edges = np.arange(-n_bins, n_bins+1) * bin_width
+    hist = np.zeros(2*n_bins, dtype=np.int64)
+    times_b = np.asarray(times_b)
+    tags = np.asarray(times_a[:0]).dtype.kind in 'ui' # time tags, the delays need a sign
+    for first in range(0, len(times_a), CORRELATION_BLOCK):
+        block_a = np.asarray(times_a[first:first + CORRELATION_BLOCK])
+        if tags:
+            block_a = block_a.astype(np.int64)
+            # integer bounds, compared with times_b in its own dtype
+            lows = np.searchsorted(times_b, np.maximum(np.ceil(block_a - max_lag), 0).astype(times_b.dtype), side='left')
+            highs = np.searchsorted(times_b, np.floor(block_a + max_lag).astype(times_b.dtype), side='right')
+        else:
+            lows = np.searchsorted(times_b, block_a - max_lag, side='left')
+            highs = np.searchsorted(times_b, block_a + max_lag, side='right')
+        offset = lows[0]
+        block_b = np.asarray(times_b[offset:highs[-1]], dtype=np.int64 if tags else None)
+        lows, highs = lows - offset, highs - offset
+        ends = np.cumsum(highs - lows) # pairs of photon i of the block are ends[i-1]:ends[i]
+        total = int(ends[-1])
+        for start in range(0, total, CORRELATION_BLOCK):
+            pairs = np.arange(start, min(start + CORRELATION_BLOCK, total))
+            index_a = np.searchsorted(ends, pairs, side='right')
+            index_b = lows[index_a] + pairs - (ends[index_a] - (highs[index_a] - lows[index_a]))
+            if auto:
+                keep = index_a + first != index_b + offset
+                index_a, index_b = index_a[keep], index_b[keep]
+            delays = block_b[index_b] - block_a[index_a]
+            bins = np.floor_divide(delays + n_bins*bin_width, bin_width).astype(np.int64)
+            bins = bins[(bins >= 0) & (bins < 2*n_bins)]
+            hist += np.bincount(bins, minlength=2*n_bins)
+    return hist, edges
+
+
+def to_seconds(tags, resolution):
+    """Converts time tags to seconds, resolution being the tag unit in ps"""
+    return np.asarray(tags, dtype=np.float64) * (resolution * 1e-12)
+
+
+class RecordBuffer(object):
+    """
+    Growable, preallocated uint32 buffer the FIFO is drained into.
+
+    The card writes straight into the numpy array through a ctypes pointer
+    (see reserve), so records never become Python objects. The array is only
+    reallocated when it runs out of room, and is reused from shot to shot.
+
+    Once a shot holds more than spill_threshold records, they are moved to a
+    scratch file in spill_dir (the system temporary directory if None) and
+    every following chunk is appended to it, so that the memory used stays
+    bounded. view then returns a read only memory map of the file.
+    """
+
+    def __init__(self, capacity, spill_threshold=None, spill_dir=None):
+        self.data = np.empty(capacity, dtype=np.uint32)
+        self.filled = 0 # records in self.data
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.spill_file = None
+        self.spill_path = None
+        self.spilled = 0 # records in the spill file
+
+    @property
+    def size(self):
+        return self.spilled + self.filled
+
+    def clear(self):
+        self.filled = 0
+        if self.spill_file is not None:
+            self.spill_file.close()
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass # still mapped by the arrays of the previous shot (Windows), left in the temporary directory
+            self.spill_file = None
+            self.spill_path = None
+            self.spilled = 0
+
+    def reserve(self, n):
+        """
+        Makes room for n more records and returns a ctypes pointer to the
+        first free record
+        """
+        if self.filled + n > self.data.size:
+            data = np.empty(max(2*self.data.size, self.filled + n), dtype=np.uint32)
+            data[:self.filled] = self.data[:self.filled]
+            self.data = data
+        return self.data[self.filled:].ctypes.data_as(ct.POINTER(ct.c_uint))
+
+    def commit(self, n):
+        """Marks n records written at the last reserved position as valid"""
+        self.filled += n
+        if self.spill_file is None and self.spill_threshold is not None and self.size > self.spill_threshold:
+            fd, self.spill_path = tempfile.mkstemp(prefix='th260_records_', suffix='.raw', dir=self.spill_dir)
+            self.spill_file = os.fdopen(fd, 'wb')
+            print('more than %d records, spilling them to %s' % (self.spill_threshold, self.spill_path))
+        if self.spill_file is not None : self._spill()
+
+    def _spill(self):
+        self.spill_file.write(self.data[:self.filled].tobytes())
+        self.spilled += self.filled
+        self.filled = 0
+
+    def append(self, records):
+        """Copies an array of records at the end of the buffer"""
+        n = len(records)
+        self.reserve(n)
+        self.data[self.filled:self.filled+n] = records
+        self.commit(n)
+
+    def view(self):
+        """Returns the valid records, without copying them"""
+        if self.spill_file is None:
+            return self.data[:self.filled]
+        self._spill()
+        self.spill_file.flush()
+        return np.memmap(self.spill_path, dtype=np.uint32, mode='r', shape=(self.spilled,))
+
+
+class PhaseTimer(object):
+    """
+    Accumulates the wall clock duration of the named phases of a shot, in s,
+    in the order they first ran
+
+        timer = PhaseTimer()
+        with timer.phase('decode'):
+            ...
+    """
+
+    def __init__(self):
+        self.names = []
+        self.durations = {}
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - t0)
+
+    def add(self, name, duration):
+        """Adds a duration measured elsewhere, e.g. by the card"""
+        if name not in self.durations:
+            self.names.append(name)
+            self.durations[name] = 0.
+        self.durations[name] += duration
+
+    def split(self, name, part, duration):
+        """
+        Moves duration, measured within the phase name (e.g. by the card), out
+        of it to the phase part, so that the phases never overlap and their
+        durations add up to the time of the shot
+        """
+        if name in self.durations : self.durations[name] = max(self.durations[name] - duration, 0.)
+        self.add(part, duration)
+
+    def items(self):
+        return [(name, self.durations[name]) for name in self.names]
+
+
+# binary recording of the raw FIFO records, see RecordingFile
+RECORDING_MAGIC = b'TH260REC'
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct('<8sI') # magic, version
+RECORDING_BLOCK = struct.Struct('<dI') # time in s, number of records or SHOT_MARKER
+RECORDING_SHOT = struct.Struct('<d16s') # resolution in ps, measurement mode
+SHOT_MARKER = 0xFFFFFFFF
+
+
+# flags of TH260_GetFlags (see TH260lib manual)
+FLAG_OVERFLOW = 0x0001 # histogram mode only
+FLAG_FIFOFULL = 0x0002
+FLAG_SYNC_LOST = 0x0004
+FLAG_REF_LOST = 0x0008
+FLAG_SYSERROR = 0x0010
+FLAG_ACTIVE = 0x0020
+FLAG_CNTS_DROPPED = 0x0040
+
+
+def telemetry_dtype(n_channels):
+    """
+    dtype of the telemetry samples of a shot (see TH260_Card.sample_telemetry) :
+    the time of the sample after the start of the measurement in s, the sync
+    rate and the count rate of each channel in Hz, the flags and warnings
+    """
+    return np.dtype([('t', np.float64), ('sync_rate', np.int32), ('count_rates', np.int32, (n_channels,)),
+                     ('flags', np.int32), ('warnings', np.int32)])
+
+
+def summarize_telemetry(samples):
+    """
+    Aggregates the telemetry samples of a shot : number of samples, mean and
+    max sync rate, max count rate over the channels, and the flags and
+    warnings raised by any sample (bitwise or)
+    """
+    summary = collections.OrderedDict()
+    summary['n_samples'] = int(samples.size)
+    if samples.size == 0 : return summary
+    summary['mean_sync_rate'] = float(np.mean(samples['sync_rate']))
+    summary['max_sync_rate'] = int(np.max(samples['sync_rate']))
+    summary['max_count_rate'] = int(np.max(samples['count_rates'])) if samples['count_rates'].size else 0
+    summary['flags'] = int(np.bitwise_or.reduce(samples['flags']))
+    summary['warnings'] = int(np.bitwise_or.reduce(samples['warnings']))
+    return summary
+
+
+class RecordingFile(object):
+    """
+    Writes the raw FIFO records of successive shots to a compact binary file,
+    to replay them later without the card (see read_recording and
+    TH260_dev_replay).
+
+    After a header, each shot starts with a marker block holding the wall
+    clock time, the resolution and the measurement mode, followed by one
+    block per chunk read from the FIFO : its time from the start of the shot
+    in s, its number of records and the uint32 records.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION))
+
+    def start_shot(self, t, resolution, mode):
+        """t is the wall clock time of the start of the measurement"""
+        self.file.write(RECORDING_BLOCK.pack(t, SHOT_MARKER))
+        self.file.write(RECORDING_SHOT.pack(resolution, mode.encode('ascii')))
+
+    def write_chunk(self, t, records):
+        """t is the time the chunk was read, from the start of the shot"""
+        records = np.ascontiguousarray(records, dtype='<u4')
+        self.file.write(RECORDING_BLOCK.pack(t, records.size))
+        self.file.write(records.tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+def index_recording(path):
+    """
+    Indexes a file written by RecordingFile without loading its records, so
+    that a long recording is read one shot at a time (see read_chunks)
+
+    returns a list of shots, each a dict with the keys 'time', 'resolution',
+        'mode' and 'chunks', the list of (t, offset, n) of its chunks in the
+        order they were read from the FIFO : the n records of the chunk start
+        at byte offset of the file
+    """
+    shots = []
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        magic, version = RECORDING_HEADER.unpack(f.read(RECORDING_HEADER.size))
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+            raise ValueError('%s is not a TH260 recording' % path)
+        while True:
+            block = f.read(RECORDING_BLOCK.size)
+            if len(block) < RECORDING_BLOCK.size : break
+            t, n = RECORDING_BLOCK.unpack(block)
+            if n == SHOT_MARKER:
+                resolution, mode = RECORDING_SHOT.unpack(f.read(RECORDING_SHOT.size))
+                shots.append({'time': t, 'resolution': resolution,
+                              'mode': mode.rstrip(b'\0').decode('ascii'), 'chunks': []})
+            else:
+                offset = f.tell()
+                if offset + 4*n > size : break # truncated by a crash during the recording
+                shots[-1]['chunks'].append((t, offset, n))
+                f.seek(4*n, os.SEEK_CUR)
+    return shots
+
+
+def read_chunks(path, chunks):
+    """Yields the (t, records) of chunks, a list of (t, offset, n) of index_recording, reading them one by one"""
+    with open(path, 'rb') as f:
+        for t, offset, n in chunks:
+            f.seek(offset)
+            yield t, np.frombuffer(f.read(4*n), dtype='<u4').astype(np.uint32)
+
+
+def read_recording(path):
+    """
+    Reads a whole file written by RecordingFile in memory
+
+    returns the shots of index_recording, with 'chunks' the list of
+        (t, records) in the order they were read from the FIFO
+    """
+    shots = index_recording(path)
+    for shot in shots:
+        shot['chunks'] = list(read_chunks(path, shot['chunks']))
+    return shots
+
+
+def segment_bounds(arrival_times, sync_times):
+    """
+    Finds the photons recorded between each pair of sync markers.
+
+    arrival_times : sorted arrival times
+    sync_times : sync markers, opening and closing each exposure in turn. If
+        the last closing marker is missing, the last exposure extends to the
+        end of the acquisition.
+
+    returns starts, stops, opens : for exposure i, the photons are
+        arrival_times[starts[i]:stops[i]], and opens[i] is its opening marker
+    """
+    opens = sync_times[::2]
+    closes = sync_times[1::2]
+    starts = np.searchsorted(arrival_times, opens, side='right')
+    stops = np.full(len(opens), len(arrival_times), dtype=starts.dtype)
+    stops[:len(closes)] = np.searchsorted(arrival_times, closes, side='left')
+    stops = np.maximum(starts, stops)
+    return starts, stops, opens
+
+
+def segment_traces(arrival_times, sync_times):
+    """
+    Splits the arrival times in one trace per exposure (see segment_bounds)
+
+    returns traces, opens : traces is a list of views into arrival_times,
+        still in absolute time, opens holds the opening marker of each trace
+    """
+    starts, stops, opens = segment_bounds(arrival_times, sync_times)
+    traces = [arrival_times[start:stop] for start, stop in zip(starts, stops)]
+    return traces, opens
+
+
+def _concatenate(chunks, dtype):
+    if not chunks : return np.zeros(0, dtype=dtype)
+    return np.concatenate(chunks)
+
+
+class IncrementalSegmenter(object):
+    """
+    Splits the photons of a T2 shot per exposure and per channel while the
+    FIFO is drained : each chunk of raw records is decoded as it is read
+    (see feed), the overflow correction and the sync count being carried
+    over from one chunk to the next, and the photons between the opening
+    and the closing markers of an exposure are added to its trace. The
+    traces match those of segment_bounds on the whole shot, so that once the
+    last chunk is fed the shot only needs to be concatenated (see finish).
+
+    n_exposures : number of exposures of the shot, the syncs beyond their
+        markers (padding) open no trace
+    channels : input channels recorded
+    """
+
+    def __init__(self, n_exposures, channels):
+        self.n_exposures = n_exposures
+        self.channels = list(channels)
+        self.oflcorrection = 0
+        self.n_syncs = 0 # syncs fed so far
+        self.last_sync = None # last sync fed, a photon at the very same time is in no trace
+        self.sync_chunks, self.time_chunks, self.channel_chunks = [], [], []
+        self.channel_time_chunks = dict((channel, []) for channel in self.channels)
+        self.n_photons = dict((channel, 0) for channel in self.channels)
+        # trace of exposure i on channel c : photons starts[c][i] to stops[c][i] of that channel, -1 until one is found
+        self.starts = dict((channel, np.full(n_exposures, -1, dtype=np.int64)) for channel in self.channels)
+        self.stops = dict((channel, np.full(n_exposures, -1, dtype=np.int64)) for channel in self.channels)
+
+    def feed(self, records):
+        """Decodes a chunk of raw T2 records, the next one read from the FIFO, and segments its photons"""
+        sync_times, times, channels, self.oflcorrection = decode_t2(records, self.oflcorrection)
+        self.sync_chunks.append(sync_times)
+        self.time_chunks.append(times)
+        self.channel_chunks.append(channels)
+        if len(self.channels) > 1:
+            channel_times = demultiplex(times, channels, self.channels)
+        else:
+            channel_times = {self.channels[0]: times}
+        for channel, times in channel_times.items():
+            if len(self.channels) > 1 : self.channel_time_chunks[channel].append(times)
+            self._assign(channel, times, sync_times)
+            self.n_photons[channel] += times.size
+        self.n_syncs += sync_times.size
+        if sync_times.size : self.last_sync = sync_times[-1]
+
+    def _assign(self, channel, times, sync_times):
+        """Extends the traces of channel with the photons times of a chunk, sync_times being the syncs of the chunk"""
+        before = np.searchsorted(sync_times, times, side='left') # syncs before each photon
+        inside = before == np.searchsorted(sync_times, times, side='right') # not at the time of a sync
+        if self.last_sync is not None : inside &= times != self.last_sync
+        before += self.n_syncs
+        inside &= (before % 2 == 1) & (before < 2*self.n_exposures) # after an opening marker, before its closing one
+        index = np.flatnonzero(inside)
+        if index.size == 0 : return
+        exposures, first = np.unique((before[index] - 1) // 2, return_index=True) # sorted, as the photons are
+        last = np.append(first[1:], index.size) - 1
+        starts, stops = self.starts[channel], self.stops[channel]
+        new = starts[exposures] < 0
+        starts[exposures[new]] = self.n_photons[channel] + index[first[new]]
+        stops[exposures] = self.n_photons[channel] + index[last] + 1
+
+    def finish(self):
+        """
+        returns sync_times, times, channels, channel_times, bounds
+            sync_times, times, channels : the whole shot, as decode_t2 returns it
+            channel_times : the times of each channel, as demultiplex returns them
+            bounds : {channel: (starts, stops)}, the trace of exposure i is
+                channel_times[channel][starts[i]:stops[i]], for each exposure
+                opened by a sync
+        """
+        sync_times = _concatenate(self.sync_chunks, np.uint64)
+        times = _concatenate(self.time_chunks, np.uint64)
+        channels = _concatenate(self.channel_chunks, np.uint8)
+        if len(self.channels) > 1:
+            channel_times = dict((channel, _concatenate(self.channel_time_chunks[channel], np.uint64))
+                                 for channel in self.channels)
+        else:
+            channel_times = {self.channels[0]: times}
+        opens = sync_times[:2*self.n_exposures:2]
+        bounds = {}
+        for channel in self.channels:
+            starts, stops = self.starts[channel][:len(opens)], self.stops[channel][:len(opens)]
+            empty = starts < 0 # placed where segment_bounds places them
+            starts[empty] = stops[empty] = np.searchsorted(channel_times[channel], opens[empty], side='right')
+            bounds[channel] = (starts, stops)
+        return sync_times, times, channels, channel_times, bounds
+
+
+class LiveHistogram(object):
+    """
+    Rolling view of the photons of successive short acquisitions, for the
+    live view of the manual mode : the histogram of the delays of the
+    photons after their previous sync, and the count rate of each channel,
+    summed over the last `history` acquisitions. Each acquisition is added
+    once (see add) and the oldest one is subtracted, so that the cost of a
+    frame does not grow with the window.
+
+    channels : input channels shown
+    bin_width : of the histogram, in units of the card resolution
+    n_bins : delays beyond n_bins*bin_width are not shown
+    history : number of acquisitions summed
+    rate_points : number of acquisitions kept in the count rate history
+    """
+
+    def __init__(self, channels, bin_width, n_bins, history=10, rate_points=300):
+        self.channels = list(channels)
+        self.bin_width = max(1, int(bin_width))
+        self.n_bins = n_bins
+        self.window = collections.deque() # (histograms, counts, n_syncs, duration) of each acquisition summed
+        self.history = history
+        self.histograms = np.zeros((len(self.channels), n_bins), dtype=np.int64)
+        self.counts = np.zeros(len(self.channels), dtype=np.int64)
+        self.n_syncs = 0
+        self.duration = 0.
+        self.rate_times = collections.deque(maxlen=rate_points)
+        self.rates = collections.deque(maxlen=rate_points)
+
+    def add(self, records, duration, t=None):
+        """Adds the raw T2 records of an acquisition of duration s, made at the time t"""
+        sync_times, times, channels, oflcorrection = decode_t2(records)
+        counts = np.array([np.count_nonzero(channels == channel) for channel in self.channels], dtype=np.int64)
+        previous = np.searchsorted(sync_times, times, side='right') - 1 # sync before each photon
+        after_sync = previous >= 0
+        bins = (times[after_sync] - sync_times[previous[after_sync]]) // np.uint64(self.bin_width)
+        channels = channels[after_sync]
+        shown = bins < self.n_bins
+        bins, channels = bins[shown].astype(np.intp), channels[shown]
+        histograms = np.zeros_like(self.histograms)
+        for i, channel in enumerate(self.channels):
+            histograms[i] = np.bincount(bins[channels == channel], minlength=self.n_bins)
+
+        self.window.append((histograms, counts, sync_times.size, duration))
+        self.histograms += histograms
+        self.counts += counts
+        self.n_syncs += sync_times.size
+        self.duration += duration
+        if len(self.window) > self.history:
+            histograms, counts, n_syncs, duration = self.window.popleft()
+            self.histograms -= histograms
+            self.counts -= counts
+            self.n_syncs -= n_syncs
+            self.duration -= duration
+        self.rate_times.append(time.time() if t is None else t)
+        self.rates.append(self.window[-1][1] / max(self.window[-1][3], 1e-9))
+
+    def frame(self, resolution, max_points=None):
+        """
+        Current state of the view, as a dict of lists (JSON serialisable).
+        The histograms are decimated, by summing neighbouring bins, to at most
+        max_points bins.
+
+        resolution : of the card in ps, the times of the frame are in s
+        """
+        histograms = self.histograms
+        factor = 1
+        if max_points is not None and self.n_bins > max_points:
+            factor = -(-self.n_bins // max_points)
+            padded = np.zeros((len(self.channels), factor * -(-self.n_bins // factor)), dtype=np.int64)
+            padded[:, :self.n_bins] = histograms
+            histograms = padded.reshape(len(self.channels), -1, factor).sum(axis=2)
+        duration = max(self.duration, 1e-9)
+        return {
+            'channels': self.channels,
+            'bin_width': self.bin_width * factor * resolution * 1e-12,
+            'histograms': histograms.tolist(),
+            'count_rates': (self.counts / duration).tolist(),
+            'sync_rate': self.n_syncs / duration,
+            'window': self.duration,
+            'rate_times': list(self.rate_times),
+            'rates': np.array(self.rates).reshape(len(self.rates), len(self.channels)).T.tolist(),
+        }
+
+
+def delta_encode(times, starts=None):
+    """
+    Delta encodes sorted integer times into small unsigned integers, which
+    compress much better once shuffled.
+
+    starts : optional start indices of segments encoded independently of each
+        other, such as the traces of the ragged layout. deltas[starts[i]] is
+        then times[starts[i]] itself, so that any segment decodes on its own.
+
+    returns deltas, first : times == first + cumsum(deltas). deltas is uint32
+        whenever the largest delta allows it, uint64 otherwise.
+    """
+    times = np.asarray(times, dtype=np.uint64)
+    deltas = np.empty_like(times)
+    if times.size == 0 : return deltas.astype(np.uint32), 0
+    deltas[1:] = times[1:] - times[:-1]
+    if starts is None:
+        first = int(times[0])
+        deltas[0] = 0
+    else:
+        first = 0
+        starts = np.asarray(starts)
+        starts = starts[starts < times.size]
+        deltas[starts] = times[starts]
+    if deltas.max() < 2**32 : deltas = deltas.astype(np.uint32)
+    return deltas, first
+
+
+def delta_decode(deltas, first=0, offsets=None):
+    """
+    Inverse of delta_encode. offsets are the bounds of the segments, as in
+    the ragged layout, when the segments were encoded independently.
+    """
+    times = np.cumsum(deltas, dtype=np.uint64)
+    if offsets is not None and times.size:
+        offsets = np.asarray(offsets)
+        lengths = np.diff(offsets)
+        before = np.concatenate(([0], times)).astype(np.uint64)[offsets[:-1]] # cumulated sum before each segment
+        times -= np.repeat(before, lengths)
+    times += np.uint64(first)
+    return times
+
+
+def create_time_dataset(group, name, data, dtype, encoding='plain', compression='gzip',
+                        compression_opts=None, starts=None, origin=None, block_size=SPILL_CHUNK, **kwargs):
+    """
+    Creates a dataset of sorted times in group, read it back with read_timestamps
+
+    encoding : 'plain' stores the times as dtype, 'delta' stores them with
+        delta_encode (integer times only), shuffled before compression
+    compression, compression_opts : h5py filter ('gzip', 'lzf' or None) and
+        its options (gzip level)
+    starts : start indices of independently encoded segments, see delta_encode
+    origin : subtracted from the times before they are stored
+    block_size : longer data, such as memory maps of spilled shots, is
+        encoded and written block by block to keep the memory used bounded
+    kwargs are passed to h5py create_dataset
+    """
+    if compression is not None:
+        kwargs['compression'] = compression
+        if compression == 'gzip' and compression_opts is not None:
+            kwargs['compression_opts'] = compression_opts
+    if len(data) > block_size:
+        return _create_time_dataset_blocks(group, name, data, dtype, encoding, starts, origin, block_size, **kwargs)
+    if origin is not None : data = data - origin
+    if encoding == 'delta':
+        data, first = delta_encode(data, starts)
+        kwargs['shuffle'] = compression is not None
+        dset = group.create_dataset(name, data=data, **kwargs)
+        dset.attrs['delta_first'] = first
+    else:
+        dset = group.create_dataset(name, data=data, dtype=dtype, **kwargs)
+    dset.attrs['encoding'] = encoding
+    return dset
+
+
+def _create_time_dataset_blocks(group, name, data, dtype, encoding, starts, origin, block_size, **kwargs):
+    """create_time_dataset for data longer than block_size, same storage"""
+    n = len(data)
+    blocks = [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+    if starts is not None : starts = np.asarray(starts)
+
+    def block(start, stop):
+        times = data[start:stop]
+        if origin is not None : times = times - origin
+        if encoding != 'delta' : return times
+        times = np.asarray(times, dtype=np.uint64)
+        previous = times[0] if start == 0 else np.uint64(data[start-1]) - np.uint64(origin or 0)
+        deltas = np.empty_like(times)
+        deltas[0] = times[0] - previous
+        deltas[1:] = times[1:] - times[:-1]
+        if starts is not None:
+            inside = starts[(starts >= start) & (starts < stop)] - start
+            deltas[inside] = times[inside]
+        return deltas
+
+    if encoding == 'delta':
+        # the dtype of the deltas is only known once they have all been computed
+        largest = max(int(block(start, stop).max()) for start, stop in blocks)
+        dtype = np.uint32 if largest < 2**32 else np.uint64
+        kwargs['shuffle'] = 'compression' in kwargs
+    dset = group.create_dataset(name, shape=(n,), dtype=dtype, **kwargs)
+    for start, stop in blocks:
+        dset[start:stop] = block(start, stop)
+    if encoding == 'delta':
+        dset.attrs['delta_first'] = 0 if starts is not None else int(np.uint64(data[0]) - np.uint64(origin or 0))
+    dset.attrs['encoding'] = encoding
+    return dset
+
+
+def read_timestamps(dset, offsets=None):
+    """
+    Reads a dataset of times written by TH260_server, undoing its storage
+    encoding. offsets is needed for the 'events' dataset of the ragged layout.
+    """
+    data = dset[:]
+    if dset.attrs.get('encoding', 'plain') == 'delta':
+        data = delta_decode(data, dset.attrs['delta_first'], offsets)
+    return data
+
+
+def as_str(value):
+    """Exposure names and frametypes may be read from h5 files as bytes"""
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+
+def read_ragged_trace(trace_group, name, frametype, channel=None):
+    """
+    Reads back one trace written with the 'ragged' storage layout of
+    TH260_server, by slicing the events dataset of trace_group. channel
+    selects the input channel when several were recorded.
+    """
+    table = trace_group['exposures'][:]
+    names = [as_str(n) for n in table['name']]
+    frametypes = [as_str(f) for f in table['frametype']]
+    for i, key in enumerate(zip(names, frametypes)):
+        if key == (name, frametype) and (channel is None or table['channel'][i] == channel):
+            offsets = trace_group['offsets'][i:i+2]
+            events = trace_group['events']
+            trace = events[offsets[0]:offsets[1]]
+            if events.attrs.get('encoding', 'plain') == 'delta':
+                trace = delta_decode(trace) # each trace is encoded on its own
+            return trace
+    raise KeyError('no trace %s/%s in %s' % (name, frametype, trace_group.name))
+
+
+class CountsReducer(object):
+    """Number of photons of a trace, and its first and last arrival times (NaN if empty)"""
+
+    def fields(self):
+        return [('count', np.int64), ('first_time', np.float64), ('last_time', np.float64)]
+
+    def attrs(self):
+        return {}
+
+    def start(self):
+        self.count, self.first, self.last = 0, np.nan, np.nan
+
+    def update(self, times):
+        if times.size == 0 : return
+        if self.count == 0 : self.first = times[0]
+        self.count += times.size
+        self.last = times[-1]
+
+    def result(self):
+        return (self.count, self.first, self.last)
+
+
+class MomentsReducer(object):
+    """Mean and standard deviation of the arrival times of a trace (NaN if empty)"""
+
+    def fields(self):
+        return [('mean_time', np.float64), ('std_time', np.float64)]
+
+    def attrs(self):
+        return {}
+
+    def start(self):
+        self.count, self.mean, self.m2 = 0, 0., 0. # m2 : sum of the squared deviations from the mean
+
+    def update(self, times):
+        if times.size == 0 : return
+        mean = np.mean(times)
+        count = self.count + times.size
+        delta = mean - self.mean
+        # the moments of the block merged with those of the previous blocks (Chan et al.)
+        self.m2 += np.sum((times - mean)**2) + delta**2 * self.count * times.size / count
+        self.mean += delta * times.size / count
+        self.count = count
+
+    def result(self):
+        if self.count == 0 : return (np.nan, np.nan)
+        return (self.mean, np.sqrt(self.m2 / self.count))
+
+
+class HistogramReducer(object):
+    """
+    Histogram of the arrival times of a trace in n_bins bins of bin_width s,
+    from the opening of the exposure. Later photons are not counted.
+    """
+
+    def __init__(self, bin_width, n_bins):
+        self.bin_width = float(bin_width)
+        self.n_bins = int(n_bins)
+
+    def fields(self):
+        return [('histogram', np.int64, (self.n_bins,))]
+
+    def attrs(self):
+        return {'histogram_bin_width': self.bin_width}
+
+    def start(self):
+        self.hist = np.zeros(self.n_bins, dtype=np.int64)
+
+    def update(self, times):
+        bins = (times // self.bin_width).astype(np.int64)
+        self.hist += np.bincount(bins[(bins >= 0) & (bins < self.n_bins)], minlength=self.n_bins)
+
+    def result(self):
+        return (self.hist,)
+
+
+# reducers of the per exposure summary of the shots (see make_reducers), more can be added here : a reducer
+# has fields() (its columns in the summary, as numpy dtype fields), attrs() (attributes of the summary dataset),
+# start(), then update(times) for each block of the times of a trace, in s from its opening sync and in order,
+# and result(), which returns the value of each field for the whole trace. Long traces are then reduced
+# block by block, without a copy of them in memory (see TH260_server.ShotWriter.write_summary)
+REDUCERS = {
+    'counts': CountsReducer,
+    'moments': MomentsReducer,
+    'histogram': HistogramReducer,
+}
+
+
+def make_reducers(specs):
+    """
+    Instantiates the reducers of a shot config (see TH260_server.DEFAULT_CONFIG) :
+    specs is a list of reducer names, or of [name, {keyword arguments}]
+    """
+    reducers = []
+    for spec in specs:
+        name, kwargs = spec if isinstance(spec, (list, tuple)) else (spec, {}) # names are unicode in python 2 json
+        if name not in REDUCERS : raise ValueError('unknown reducer %s, not one of %s' % (name, ', '.join(sorted(REDUCERS))))
+        reducers.append(REDUCERS[name](**kwargs))
+    names = [field[0] for reducer in reducers for field in reducer.fields()]
+    if len(set(names)) != len(names) : raise ValueError('reducers with the same fields : %s' % str(names))
+    return reducers
+
+
+def read_summary(trace_group, name=None, frametype=None, channel=None):
+    """
+    Reads the per exposure summary of a shot written by TH260_server (see
+    ShotWriter.write_summary), keeping the rows of the given exposure name,
+    frametype and channel, if any
+    """
+    table = trace_group['summary'][:]
+    keep = np.ones(table.size, dtype=bool)
+    if name is not None : keep &= np.array([as_str(n) == name for n in table['name']], dtype=bool)
+    if frametype is not None : keep &= np.array([as_str(f) == frametype for f in table['frametype']], dtype=bool)
+    if channel is not None : keep &= table['channel'] == channel
+    return table[keep]
@@ -1,15 +1,91 @@
 # import labscript_utils.h5_lock
+import os
 import sys
 import time
-import zprocess
+import argparse
+import shutil
+import tempfile
+import multiprocessing
 import h5py
 # from labscript_utils import check_version
 # import labscript_utils.shared_drive
 import datetime
+import json
+import base64
+import hashlib
+import collections
+import threading
+import traceback
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+import zmq
 # from TH260_dev_dummy import TH260_Card
+# from TH260_dev_replay import TH260_Card # replays shots recorded with RECORD_PATH, see TH260_dev_replay
 from TH260_dev import TH260_Card
 # from matplotlib import pyplot as pt
 import numpy as np
+from TH260_processing import segment_traces, demultiplex, correlate, create_time_dataset, as_str, PhaseTimer, decode_t2, to_seconds, \
+                              decode_t2_to_files, Aborted, IncrementalSegmenter, LiveHistogram, \
+                              summarize_telemetry, make_reducers, FLAG_FIFOFULL, FLAG_SYNC_LOST, FLAG_CNTS_DROPPED
+
+# settings of a shot, overridden by the 'server_config' written by TH260_new in the shot file
+DEFAULT_CONFIG = {
+    'storage_layout': 'groups', # 'groups' : one dataset per exposure, 'ragged' : events + offsets + exposure table
+    'virtual_datasets': False, # with the ragged layout, also expose each exposure as a virtual dataset
+    'timestamp_mode': 'seconds', # 'seconds' : float64 times in s, 'tags' : uint64 times in units of the card resolution
+    'storage_encoding': 'plain', # 'plain' or 'delta' (differences of consecutive times, 'tags' mode only)
+    'compression': 'gzip', # h5py filter of the time datasets : 'gzip', 'lzf' or None
+    'compression_opts': None, # gzip level, h5py default if None
+    'acquisition_margin': 5.0, # in s, added to the end of the last exposure to set the measurement time, covers the delay
+                               # between the arm and the trigger of the shot (the measurement time was a fixed 5 s before)
+    'early_stop': False, # stop the measurement as soon as the syncs of every exposure have been received
+    'channels': [0], # input channels to record, traces are stored per channel when there are several
+    'input_trigger_levels': None, # in mV, one per channel, card default if None
+    'measurement_mode': 'T2', # 'T2' : time tags, 'T3' : sync index + delay after the sync, 'histogram' : delay histograms made on the card
+    'binning': 0, # T3 and histogram modes : time bins of 2**binning times the base resolution
+    'offset': 0, # T3 and histogram modes : delay offset in ns
+    'spill_threshold': None, # T2 mode : number of records beyond which the shot is spilled to scratch files in SCRATCH_DIR
+                             # and processed by chunks, to bound the memory used. Never if None.
+    'feedback_mean_time': False, # add the mean arrival time of each trace to the counts feedback (see ShotWriter.counts_feedback)
+    'incremental_segmentation': False, # T2 mode : decode and segment the records while the FiFo is drained, during the shot
+                                       # (see TH260_processing.IncrementalSegmenter). Not with spill_threshold nor the pool.
+    'reducers': None, # T2 mode : reducers of the per exposure 'summary' table, names of TH260_processing.REDUCERS or
+                      # [name, {keyword arguments}], e.g. ['counts', ['histogram', {'bin_width': 1e-6, 'n_bins': 100}]]
+}
+
+SYNC_PADDING_TIME = 1.2e-3 # in s, the 20 sync pulses TH260_new.make_gate adds after the last exposure
+MAX_ACQUISITION_TIME = 360000000 # in ms, longest measurement the TH260 accepts
+
+RAGGED_CHUNK_SIZE = 65536 # events per chunk in the 'ragged' layout
+SUMMARY_BLOCK = 1 << 20 # photons of a trace converted to s at once by the reducers of the 'summary' table
+
+SCRATCH_DIR = None # directory of the memory mapped records handed to the process pool and of the files of spilled shots,
+                   # the system temporary directory if None
+
+REACTOR_POLL_INTERVAL = 5 # in ms, longest delay before the reply of a finished transition is sent
+STATS_HISTORY = 1000 # number of shots whose statistics are kept for the 'stats' request
+
+FEEDBACK_PORT_OFFSET = 1000 # the counts of every T2 shot are published on a zmq PUB socket at the port of the card plus
+                            # this offset, with the device name as topic (see ShotWriter.counts_feedback). Not if None.
+
+# live view of the manual mode, see TH260Server.set_live
+LIVE_PORT_OFFSET = 2000 # the frames are published on a zmq PUB socket at the port of the card plus this offset. No live view if None.
+LIVE_ACQUISITION_TIME = 100 # in ms, duration of each acquisition between shots
+LIVE_HISTORY = 10 # number of acquisitions summed in the histograms and count rates
+LIVE_BIN_WIDTH = 250e-12 # in s, bins of the arrival time histogram, at least the resolution of the card
+LIVE_N_BINS = 4096 # delays after the sync beyond LIVE_N_BINS*LIVE_BIN_WIDTH are not shown
+LIVE_MAX_POINTS = 1024 # the histograms are decimated to at most this number of bins before they are published
+LIVE_MAX_FPS = 10. # frames published per s at most, the acquisitions in between are still summed
+LIVE_RATE_POINTS = 300 # number of acquisitions in the count rate history
+
+RECORD_PATH = None # if set, the raw FIFO records of every shot are also saved to this file (see TH260_Card.start_recording),
+                   # suffixed by the device name when the server drives several cards
+
+# cards driven by the server, as name:devidx:port, the name and port match the labscript device and its
+# BLACS connection. Overridden by the --card command line arguments.
+DEFAULT_CARDS = ['th260:0:1028']
 
 def path_to_local(path):
     """
@@ -23,47 +99,199 @@ def path_to_local(path):
     """   
     return path
 
-class GenericServer(zprocess.ZMQServer):
+def unpack_arm_request(request_data):
+    """
+    Decodes an 'arm' request of TH260ServerWorker, carrying the h5 path, the
+    exposure table and the server config of the shot (see
+    TH260ServerWorker.arm_request)
+
+    returns h5_filepath, exposures, config, key : key identifies the table and
+        the config, to recognise shots armed identically
+    """
+    header = json.loads(request_data[len('arm '):])
+    dtype = np.dtype([(str(name), str(fmt)) for name, fmt in header['dtype']])
+    table = base64.b64decode(header['exposures'])
+    exposures = np.frombuffer(table, dtype=dtype).copy()
+    config = header['config']
+    key = hashlib.sha1(table + json.dumps(config, sort_keys=True).encode('utf8')).hexdigest()
+    return header['h5_filepath'], exposures, config, key
+
+class GenericServer(object):
+    """
+    Request server of a device, over a zmq ROUTER socket, compatible with the
+    REQ sockets of the BLACS workers.
+
+    Requests are answered by a reactor thread while transitions run in a
+    thread of their own, so that 'hello', 'stats' and 'abort' are answered
+    at once, even during a transition :
+        '<h5 path>', 'arm <json>', 'done' : transitions, answered 'ok' at once,
+            the follow-up message of the client is answered 'done' once the
+            transition is over ('aborted' or 'error: ...' otherwise). When
+            transition_to_static returns a dict, it follows as JSON : 'done {...}'
+        'wait' : answered 'done' once the shots of the pipeline pool are written, an aborted one included
+        'abort' : interrupts the running transition (see Aborted) and aborts, answered 'ok' once the shot is aborted
+        'live start', 'live stop' : turns the live view of the manual mode on or off (see set_live)
+    """
+
     def __init__(self, port):
-           zprocess.ZMQServer.__init__(self, port, type='string')
-           self._h5_filepath = None
-           self.enable = True
+        self.port = port
+        self._h5_filepath = None
+        self.enable = True
+        self.abort_event = threading.Event() # set while aborting, checked by the card and ShotWriter
+        self.transition_thread = None
+        self.transition_result = None # reply to the follow-up of a finished transition, until it is asked for
+        self.waiting_clients = [] # clients waiting for the end of the running transition
+        self.abort_clients = [] # clients of 'abort', answered once the transition thread has aborted the shot
+        self.finished = queue.Queue() # results of the transition thread, replied by the reactor
+        self._stop_reactor = threading.Event()
+        self.sock = zmq.Context.instance().socket(zmq.ROUTER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.bind('tcp://*:%d' % port)
+        self.mainloop_thread = threading.Thread(target=self.mainloop)
+        self.mainloop_thread.daemon = True
+        self.mainloop_thread.start()
+
+    def mainloop(self):
+        """Reactor : receives the requests and sends every reply, the socket is only used by this thread"""
+        poller = zmq.Poller()
+        poller.register(self.sock, zmq.POLLIN)
+        while not self._stop_reactor.is_set():
+            if poller.poll(REACTOR_POLL_INTERVAL):
+                frames = self.sock.recv_multipart()
+                client, request_data = frames[0], frames[-1].decode('utf8')
+                try:
+                    self.dispatch(client, request_data)
+                except Exception as e:
+                    sys.stderr.write('Exception while handling %s:\n%s\n' % (request_data[:100], traceback.format_exc()))
+                    self.reply(client, 'error: %s' % str(e))
+            self.reply_finished()
+        self.sock.close()
+
+    def reply(self, client, message):
+        self.sock.send_multipart([client, b'', message.encode('utf8')])
+
+    def dispatch(self, client, request_data):
+        if request_data != '' : print(request_data[:200])
+        if request_data == 'hello':
+            self.reply(client, 'hello')
+        elif request_data == 'stats':
+            self.reply(client, json.dumps(self.stats()))
+        elif request_data in ['live start', 'live stop']:
+            self.set_live(request_data == 'live start')
+            self.reply(client, 'ok')
+        elif request_data == 'abort':
+            if self.abort_transition():
+                self.abort_clients.append(client) # see reply_finished
+            else:
+                self.reply(client, 'ok')
+        elif request_data == '': # follow-up of a transition
+            if self.transition_result is not None:
+                self.reply(client, self.transition_result)
+                self.transition_result = None
+            elif self.transition_thread is not None:
+                self.waiting_clients.append(client)
+            else:
+                self.reply(client, 'error: no transition to follow up')
+        elif self.transition_thread is not None:
+            self.reply(client, 'error: busy with another transition')
+        elif request_data.endswith('.h5') or request_data.startswith('arm ') or request_data in ['done', 'wait']:
+            self.transition_result = None
+            if request_data.endswith('.h5') or request_data.startswith('arm '):
+                self.abort_event.clear() # a shot armed after an abort is not aborted
+            if request_data == 'wait':
+                self.waiting_clients.append(client)
+            else:
+                self.reply(client, 'ok')
+            self.transition_thread = threading.Thread(target=self.run_transition, args=(request_data,))
+            self.transition_thread.daemon = True
+            self.transition_thread.start()
+        else:
+            raise ValueError('invalid request: %s' % request_data[:100])
 
-    def handler(self, request_data):
+    def run_transition(self, request_data):
+        """Body of the transition thread, its result is replied by the reactor (see reply_finished)"""
         try:
-            print(request_data)
-            if request_data == 'hello':
-                return 'hello'
-            elif request_data.endswith('.h5'):
+            feedback = None
+            if request_data.endswith('.h5'):
                 self._h5_filepath = path_to_local(request_data)
-                # self._h5_filepath = path_to_local(request_data)
-                self.send('ok')
-                self.recv()
                 self.transition_to_buffered(self._h5_filepath)
-                print('here')
-                return 'done'
+            elif request_data.startswith('arm '):
+                h5_filepath, exposures, config, key = unpack_arm_request(request_data)
+                self._h5_filepath = path_to_local(h5_filepath)
+                self.transition_to_buffered(self._h5_filepath, exposures, config, key)
             elif request_data == 'done':
-                self.send('ok')
-                self.recv()
-                self.transition_to_static(self._h5_filepath)
+                feedback = self.transition_to_static(self._h5_filepath)
                 self._h5_filepath = None
-                return 'done'
-            elif request_data == 'abort':
-                self.abort()
-                self._h5_filepath = None
-                return 'ok'
-            else:
-                raise ValueError('invalid request: %s'%request_data)
-        except Exception:
-            if self._h5_filepath is not None and request_data != 'abort':
+            elif request_data == 'wait':
+                self.wait_pending()
+            if self.abort_event.is_set() : raise Aborted('aborted at the end of the transition')
+            result = 'done'
+            if isinstance(feedback, dict) : result += ' ' + json.dumps(feedback)
+        except Aborted:
+            print('transition aborted')
+            try:
+                self.abort() # the card is only used by the transition thread while it runs
+            except Exception as e:
+                sys.stderr.write('Exception in self.abort():\n{}\n'.format(traceback.format_exc()))
+            self._h5_filepath = None
+            result = 'aborted'
+        except Exception as e:
+            sys.stderr.write(traceback.format_exc())
+            if self._h5_filepath is not None:
                 try:
                     self.abort()
-                except Exception as e:
-                    sys.stderr.write('Exception in self.abort() while handling another exception:\n{}\n'.format(str(e)))
+                except Exception as e2:
+                    sys.stderr.write('Exception in self.abort() while handling another exception:\n{}\n'.format(str(e2)))
             self._h5_filepath = None
-            raise
+            result = 'error: %s' % str(e)
+        self.finished.put(result)
+
+    def reply_finished(self):
+        """Replies the result of a finished transition to the clients waiting for it"""
+        try:
+            result = self.finished.get_nowait()
+        except queue.Empty:
+            return
+        self.transition_thread = None
+        for client in self.abort_clients:
+            self.reply(client, 'ok')
+        self.abort_clients = []
+        if self.waiting_clients:
+            for client in self.waiting_clients:
+                self.reply(client, result)
+            self.waiting_clients = []
+        else:
+            self.transition_result = result
+
+    def abort_transition(self):
+        """
+        Interrupts the running transition : its FIFO read or its writes raise
+        Aborted within a chunk, and the transition thread then aborts the shot
+        itself (see run_transition), so that the card is never used by two
+        threads. Without a transition, the shot is aborted here. The abort
+        holds until the next shot is armed.
 
-    def transition_to_buffered(self, h5_filepath):
+        returns whether a transition is aborting
+        """
+        self.abort_event.set()
+        self.interrupt()
+        if self.transition_thread is not None : return True
+        self.abort()
+        self._h5_filepath = None
+        return False
+
+    def interrupt(self):
+        """Called at an abort, makes the device stop what the transition thread is waiting for"""
+        pass
+
+    def set_live(self, enabled):
+        raise ValueError('no live view for this device')
+
+    def shutdown(self):
+        self._stop_reactor.set()
+        self.mainloop_thread.join()
+
+    def transition_to_buffered(self, h5_filepath, exposures=None, config=None, key=None):
         print('transition to buffered')
 
     def transition_to_static(self, h5_filepath):
@@ -72,6 +300,452 @@ class GenericServer(zprocess.ZMQServer):
     def abort(self):
         print('abort')
 
+    def stats(self):
+        return {}
+
+    def wait_pending(self, max_pending=0):
+        pass
+
+
+class ShotWriter(object):
+    """
+    Saves the data of one shot in its h5 file. It holds everything the saving
+    needs, so that it runs the same in the server or in a process of the
+    pipeline pool (see process_shot).
+
+    exposures : exposure table of the shot, sorted by time here
+    config : the shot config, see DEFAULT_CONFIG
+    resolution : of the card, in ps
+    timer : PhaseTimer of the shot, the phases of the saving are added to it
+    read_stats : statistics of the card read, see TH260_Card.read_records
+    telemetry : rates, flags and warnings sampled during the shot, see TH260_Card.read_telemetry
+    """
+
+    def __init__(self, device_name, h5_filepath, exposures, config, resolution, timer, read_stats=None, telemetry=None):
+        self.device_name = device_name
+        self.h5_filepath = h5_filepath
+        self.exposures = np.sort(exposures, order='t')
+        self.n_traces = len(self.exposures)
+        self.config = config
+        self.resolution = resolution
+        self.timer = timer
+        self.read_stats = dict(read_stats or {})
+        self.telemetry = telemetry
+        self.time_dtype = np.uint64 if config['timestamp_mode'] == 'tags' else 'float'
+        self.scratch_dir = None # files of a spilled shot
+        self.channel_times = None # times of each channel, when decoded by decode_t2_to_files or take_segments
+        self.trace_bounds = None # {channel: (starts, stops)} of the traces in channel_times, set by take_segments
+        self.abort_event = None # the writing raises Aborted once set, see check_abort
+        self.feedback = None # counts of the shot, see counts_feedback
+        self.on_feedback = None # called with the counts of the shot as soon as it is segmented, before it is written
+
+    def check_abort(self):
+        """Raises Aborted if the server aborted the shot, checked between datasets (one write is not interrupted)"""
+        if self.abort_event is not None and self.abort_event.is_set():
+            raise Aborted('writing of %s aborted' % self.h5_filepath)
+
+    def decode(self, records):
+        """
+        Decodes the raw T2 records of the shot as TH260_Card.readBuffer does.
+        Beyond the spill_threshold of the config, the records are decoded by
+        chunks into memory mapped scratch files (see decode_t2_to_files).
+
+        returns sync_times, arrival_times, arrival_channels
+        """
+        threshold = self.config['spill_threshold']
+        resolution = None if self.time_dtype == np.uint64 else self.resolution
+        with self.timer.phase('decode'):
+            if threshold is not None and len(records) > threshold:
+                self.scratch_dir = tempfile.mkdtemp(prefix='th260_shot_', dir=SCRATCH_DIR)
+                channels = self.config['channels'] if len(self.config['channels']) > 1 else None
+                sync_times, arrival_times, arrival_channels, self.channel_times = decode_t2_to_files(
+                    records, self.scratch_dir, resolution, channels
+                )
+                return sync_times, arrival_times, arrival_channels
+            sync_times, arrival_times, arrival_channels, oflcorrection = decode_t2(records)
+            if resolution is not None:
+                sync_times, arrival_times = to_seconds(sync_times, resolution), to_seconds(arrival_times, resolution)
+        return sync_times, arrival_times, arrival_channels
+
+    def take_segments(self, segmenter):
+        """
+        Takes the shot decoded and segmented during the acquisition by
+        segmenter (an IncrementalSegmenter fed with every chunk of records),
+        instead of decoding it (see decode)
+
+        returns sync_times, arrival_times, arrival_channels
+        """
+        with self.timer.phase('decode'):
+            sync_times, arrival_times, arrival_channels, channel_times, self.trace_bounds = segmenter.finish()
+            if self.time_dtype != np.uint64:
+                sync_times, arrival_times = to_seconds(sync_times, self.resolution), to_seconds(arrival_times, self.resolution)
+                if len(channel_times) > 1:
+                    channel_times = dict((channel, to_seconds(times, self.resolution)) for channel, times in channel_times.items())
+                else:
+                    channel_times = dict((channel, arrival_times) for channel in channel_times)
+        self.channel_times = channel_times
+        return sync_times, arrival_times, arrival_channels
+
+    def scratch_array(self, n, dtype):
+        """Array of n elements, memory mapped in the scratch directory when the shot is spilled"""
+        if self.scratch_dir is None or n == 0 : return np.empty(n, dtype=dtype)
+        fd, path = tempfile.mkstemp(dir=self.scratch_dir)
+        os.close(fd)
+        return np.memmap(path, dtype=dtype, mode='w+', shape=(n,))
+
+    def release_scratch(self):
+        """Removes the scratch files of a spilled shot"""
+        self.channel_times = None
+        self.trace_bounds = None
+        if self.scratch_dir is None : return
+        shutil.rmtree(self.scratch_dir, ignore_errors=True) # files still mapped (Windows) stay in the temporary directory
+        self.scratch_dir = None
+
+    def save_traces(self, sync_times, arrival_times, arrival_channels):
+        """
+        Splits the photons of a T2 shot per exposure and writes them, with all
+        the sync and arrival times, in the shot file
+
+        returns the statistics of the shot, see write_stats
+        """
+        channels = self.config['channels']
+        """
+        Sorting traces as a function of sync events :
+        """
+        sync_times = sync_times[:2*self.n_traces]  #we had to add 20 sync pulses at the end so the buffer transfer doesn't go crazy because of very low count numbers (see manual for TH260lib.dll, section 5.3)
+                                                    # so now we're just taking the right amount of flags, defined by the number of exposures we expect.
+        if sync_times.size % 2 == 1 :
+            print('last sync missed, sending all the rest')
+        # Iterate over expected exposures, sorted by acquisition time, to match them
+        # up with the acquired traces:
+        with self.timer.phase('segment'):
+            self.segment(sync_times, arrival_times, arrival_channels)
+            self.feedback = self.counts_feedback()
+        if self.on_feedback is not None : self.on_feedback(self.feedback)
+        self.check_abort()
+        print("Saving %d/%d traces." % (self.n_segments, len(self.exposures)))
+
+        with self.timer.phase('open_file'):
+            f = h5py.File(self.h5_filepath, 'r+')
+        with f:
+            trace_path = 'data/time_arrays/' + self.device_name
+            trace_group = f.require_group(trace_path)
+            trace_group.attrs['camera'] = self.device_name
+
+            # Whether we failed to get all the expected exposures:
+            trace_group.attrs['failed_shot'] = self.n_segments != len(self.exposures)
+            # times are in s, or in units of resolution_ps with timestamp_mode 'tags' (see TH260_processing.to_seconds)
+            trace_group.attrs['timestamp_mode'] = self.config['timestamp_mode']
+            trace_group.attrs['measurement_mode'] = 'T2'
+            trace_group.attrs['resolution_ps'] = self.resolution
+            trace_group.attrs['channels'] = channels
+
+            with self.timer.phase('write_times'):
+                dset = self.create_time_dataset(trace_group, 'sync_times', sync_times)
+                self.check_abort()
+                dset = self.create_time_dataset(trace_group, 'arrival_times', arrival_times)
+                if len(channels) > 1:
+                    dset = trace_group.create_dataset(
+                        'arrival_channels', data=arrival_channels, compression=self.config['compression']
+                    )
+
+            trace_group.attrs['storage_layout'] = self.config['storage_layout']
+            with self.timer.phase('write_traces'):
+                if self.config['storage_layout'] == 'ragged':
+                    self.write_ragged(trace_group)
+                else:
+                    self.write_exposure_groups(trace_group)
+            if self.config['reducers']:
+                with self.timer.phase('reduce'):
+                    self.write_summary(trace_group)
+            with self.timer.phase('correlations'):
+                self.write_correlations(trace_group)
+            stats = self.write_stats(f, trace_group, n_events=arrival_times.size)
+
+        self.traces = None
+        self.trace_opens = None
+        self.trace_exposures = None
+        self.trace_channels = None
+        self.trace_indices = None
+        self.release_scratch()
+        return stats
+
+    def save_card_data(self, data):
+        """
+        Saves the data of a shot in T3 or histogram mode. The sync input is
+        the period clock in these modes, so the data is not split per exposure :
+        T3 records are stored per shot as 'nsync' (sync index), 'dtime' (delay
+        after the sync, in units of resolution_ps) and 'channels', with the
+        external markers in 'marker_nsync' and 'marker_channels'. Histograms
+        are stored as one 'histogram_ch<k>' dataset per channel.
+
+        returns the statistics of the shot, see write_stats
+        """
+        mode = self.config['measurement_mode']
+        with self.timer.phase('open_file'):
+            f = h5py.File(self.h5_filepath, 'r+')
+        with f:
+            trace_group = f.require_group('data/time_arrays/' + self.device_name)
+            trace_group.attrs['camera'] = self.device_name
+            trace_group.attrs['measurement_mode'] = mode
+            trace_group.attrs['resolution_ps'] = self.resolution
+            trace_group.attrs['channels'] = self.config['channels']
+            trace_group.attrs['failed_shot'] = False
+            with self.timer.phase('write_traces'):
+                for name in sorted(data):
+                    dset = trace_group.create_dataset(name, data=data[name], compression=self.config['compression'])
+            stats = self.write_stats(f, trace_group, n_events=data['nsync'].size if mode == 'T3' else None)
+        print("Saved %s data of %d exposures." % (mode, len(self.exposures)))
+        return stats
+
+    def write_stats(self, f, trace_group, n_events=None):
+        """
+        Saves the performance statistics of the shot as attributes of
+        trace_group : the duration in s of each phase of the transitions as
+        'timing_<phase>', the card read statistics (see
+        TH260_Card.read_records), the number of events and the bytes written.
+        The drain and decode times measured by the card are split out of the
+        'read_buffer' phase as 'card_drain' and 'card_decode', so that no time
+        is counted twice.
+        The telemetry samples are saved in the dataset 'telemetry', and their
+        aggregates as 'telemetry_<name>' (see summarize_telemetry).
+
+        returns the statistics, kept by the server for the 'stats' request
+        """
+        with self.timer.phase('flush'):
+            f.flush()
+        read_stats = dict(self.read_stats)
+        for name in ['drain_time', 'decode_time']:
+            if name in read_stats : self.timer.split('read_buffer', 'card_' + name[:-len('_time')], read_stats.pop(name))
+        if self.telemetry is not None:
+            dset = trace_group.create_dataset('telemetry', data=self.telemetry)
+            dset.attrs['channels'] = self.config['channels']
+            for name, value in summarize_telemetry(self.telemetry).items():
+                read_stats['telemetry_' + name] = value
+        sizes = []
+        trace_group.visititems(lambda name, item: sizes.append(item.id.get_storage_size()) if isinstance(item, h5py.Dataset) else None)
+
+        stats = collections.OrderedDict()
+        stats['time'] = time.time()
+        stats['h5_filepath'] = self.h5_filepath
+        for name, duration in self.timer.items():
+            stats['timing_' + name] = duration
+        for name in sorted(read_stats):
+            stats[name] = read_stats[name]
+        if n_events is not None : stats['n_events'] = int(n_events)
+        stats['bytes_written'] = int(sum(sizes))
+        for name, value in stats.items():
+            if name not in ['time', 'h5_filepath'] : trace_group.attrs[name] = value
+        print(', '.join('%s %.3f s' % (name, duration) for name, duration in self.timer.items()))
+        return stats
+
+    def segment(self, sync_times, arrival_times, arrival_channels):
+        """
+        Splits the photons in one trace per exposure and per channel. Trace i
+        holds the photons of channel self.trace_channels[i] during exposure
+        self.trace_exposures[i], as a view into the arrival times, opened by
+        the sync at self.trace_opens[i].
+        """
+        channels = self.config['channels']
+        if self.channel_times is not None:
+            channel_times = self.channel_times # already split while decoding a spilled shot
+        elif len(channels) > 1:
+            channel_times = demultiplex(arrival_times, arrival_channels, channels)
+        else:
+            channel_times = {channels[0]: arrival_times}
+        self.traces, self.trace_opens, self.trace_exposures, self.trace_channels = [], [], [], []
+        self.trace_indices = []
+        for channel in channels:
+            if self.trace_bounds is not None: # already segmented during the acquisition
+                starts, stops = self.trace_bounds[channel]
+                opens = sync_times[::2][:len(starts)]
+                traces = [channel_times[channel][start:stop] for start, stop in zip(starts, stops)]
+            else:
+                traces, opens = segment_traces(channel_times[channel], sync_times) # views, still in absolute time
+            self.traces += traces
+            self.trace_opens += list(opens)
+            self.trace_exposures += list(self.exposures[:len(traces)])
+            self.trace_channels += [channel]*len(traces)
+            self.trace_indices += list(range(len(traces)))
+        self.n_segments = len(opens)
+
+    def counts_feedback(self):
+        """
+        Reduced result of the segmented shot, for feedback, as lists with one
+        item per trace : the name, frametype and channel of the trace and its
+        number of photons, and with feedback_mean_time in the config the mean
+        arrival time of its photons after the opening sync, in s (None if the
+        trace is empty).
+        """
+        feedback = {
+            'device': self.device_name,
+            'h5_filepath': self.h5_filepath,
+            'n_exposures': self.n_traces,
+            'names': [as_str(exposure['name']) for exposure in self.trace_exposures],
+            'frametypes': [as_str(exposure['frametype']) for exposure in self.trace_exposures],
+            'channels': [int(channel) for channel in self.trace_channels],
+            'counts': [int(trace.size) for trace in self.traces],
+        }
+        if self.config['feedback_mean_time']:
+            unit = self.resolution * 1e-12 if self.time_dtype == np.uint64 else 1. # in s
+            feedback['mean_times'] = [(float(np.mean(trace, dtype=np.float64)) - float(t0)) * unit if trace.size else None
+                                      for trace, t0 in zip(self.traces, self.trace_opens)]
+        return feedback
+
+    def trace_name(self, exposure, channel):
+        """Name of the dataset of a trace, suffixed by its channel when several are recorded"""
+        if len(self.config['channels']) > 1:
+            return '%s_ch%d' % (as_str(exposure['frametype']), channel)
+        return exposure['frametype']
+
+    def create_time_dataset(self, group, name, data, starts=None, **kwargs):
+        """
+        Creates a dataset of sorted times with the encoding and compression of
+        the shot config (see TH260_processing.create_time_dataset)
+        """
+        encoding = self.config['storage_encoding']
+        if encoding == 'delta' and self.time_dtype != np.uint64:
+            print("delta encoding needs timestamp_mode 'tags', storing %s as plain times" % name)
+            encoding = 'plain'
+        return create_time_dataset(group, name, data, self.time_dtype, encoding,
+                                   self.config['compression'], self.config['compression_opts'],
+                                   starts=starts, **kwargs)
+
+    def write_summary(self, trace_group):
+        """
+        Writes the dataset 'summary' of trace_group : one row per trace, with
+        the name, frametype, channel and opening sync time of the trace and
+        the fields of each reducer of the config, computed on the photon times
+        in s after the opening sync (see TH260_processing.REDUCERS). The
+        attributes of the reducers are those of the dataset.
+        see TH260_processing.read_summary to read it back
+        """
+        reducers = make_reducers(self.config['reducers'])
+        vlenstr = h5py.special_dtype(vlen=str)
+        fields = [field for reducer in reducers for field in reducer.fields()]
+        table = np.zeros(len(self.traces), dtype=[('name', vlenstr), ('frametype', vlenstr), ('channel', np.uint8),
+                                                  ('sync_time', self.time_dtype)] + fields)
+        table['name'] = [exposure['name'] for exposure in self.trace_exposures]
+        table['frametype'] = [exposure['frametype'] for exposure in self.trace_exposures]
+        table['channel'] = self.trace_channels
+        table['sync_time'] = self.trace_opens
+        unit = self.resolution * 1e-12 if self.time_dtype == np.uint64 else 1. # in s
+        for i, (trace, t0) in enumerate(zip(self.traces, self.trace_opens)):
+            for reducer in reducers : reducer.start()
+            for start in range(0, len(trace), SUMMARY_BLOCK): # memory mapped traces of spilled shots are read a block at a time
+                times = (np.asarray(trace[start:start + SUMMARY_BLOCK], dtype=np.float64) - float(t0)) * unit
+                for reducer in reducers : reducer.update(times)
+            for reducer in reducers:
+                for field, value in zip(reducer.fields(), reducer.result()):
+                    table[field[0]][i] = value
+        self.check_abort()
+        dset = trace_group.create_dataset('summary', data=table)
+        for reducer in reducers : dset.attrs.update(reducer.attrs())
+
+    def write_correlations(self, trace_group):
+        """
+        For each exposure with g2 settings, writes the correlation histogram
+        of every pair of channels (auto-correlation included) in the dataset
+        'name/frametype_g2_ch<a>_ch<b>', with the bin edges in s as an
+        attribute
+        """
+        if 'g2_bin_width' not in self.exposures.dtype.names : return
+        traces = dict(((index, channel), trace) for index, channel, trace in
+                      zip(self.trace_indices, self.trace_channels, self.traces))
+        channels = self.config['channels']
+        unit = self.resolution * 1e-12 if self.time_dtype == np.uint64 else 1. # in s
+        for index in range(self.n_segments):
+            exposure = self.exposures[index]
+            if exposure['g2_bin_width'] <= 0 : continue
+            bin_width = exposure['g2_bin_width'] / unit
+            max_lag = exposure['g2_max_lag'] / unit
+            if self.time_dtype == np.uint64:
+                bin_width, max_lag = max(1, int(round(bin_width))), int(round(max_lag))
+            self.check_abort()
+            expos_group = trace_group.require_group(exposure['name'])
+            for i, channel_a in enumerate(channels):
+                for channel_b in channels[i:]:
+                    hist, edges = correlate(traces[index, channel_a], traces[index, channel_b], bin_width, max_lag,
+                                            auto=channel_a == channel_b)
+                    dset = expos_group.create_dataset(
+                        '%s_g2_ch%d_ch%d' % (as_str(exposure['frametype']), channel_a, channel_b), data=hist
+                    )
+                    dset.attrs['edges'] = edges * unit
+
+    def write_exposure_groups(self, trace_group):
+        """
+        Writes each trace in its own dataset 'name/frametype' of trace_group,
+        'name/frametype_ch<channel>' when several channels are recorded
+        """
+        for trace, t0, exposure, channel in zip(self.traces, self.trace_opens, self.trace_exposures, self.trace_channels):
+            self.check_abort()
+            expos_group = trace_group.require_group(exposure['name'])
+            dset = self.create_time_dataset(expos_group, self.trace_name(exposure, channel), trace, origin=t0)
+
+    def write_ragged(self, trace_group):
+        """
+        Writes all the traces of the shot in three datasets of trace_group :
+            events : the photon times of every trace, relative to their opening sync, one trace after the other
+            offsets : trace i is events[offsets[i]:offsets[i+1]]
+            exposures : the exposure table, with the channel of each trace, in the same order as the traces
+        see TH260_processing.read_ragged_trace to read a trace back
+        """
+        n = len(self.traces)
+        offsets = np.zeros(n+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([trace.size for trace in self.traces])
+        events = self.scratch_array(offsets[-1], self.time_dtype)
+        for i, (trace, t0) in enumerate(zip(self.traces, self.trace_opens)):
+            np.subtract(trace, t0, out=events[offsets[i]:offsets[i+1]])
+        self.check_abort()
+
+        events_dset = self.create_time_dataset(
+            trace_group, 'events', events, starts=offsets[:-1], chunks=(RAGGED_CHUNK_SIZE,), maxshape=(None,)
+        )
+        trace_group.create_dataset('offsets', data=offsets)
+        vlenstr = h5py.special_dtype(vlen=str)
+        table = np.zeros(n, dtype=[('name', vlenstr), ('frametype', vlenstr), ('t', float), ('trigger_duration', float),
+                                   ('sync_time', self.time_dtype), ('channel', np.uint8)])
+        for field in ['name', 'frametype', 't', 'trigger_duration']:
+            table[field] = [exposure[field] for exposure in self.trace_exposures]
+        table['sync_time'] = self.trace_opens
+        table['channel'] = self.trace_channels
+        trace_group.create_dataset('exposures', data=table)
+
+        if self.config['virtual_datasets']:
+            # keeps the 'name/frametype' paths of the 'groups' layout readable
+            for i, (exposure, channel) in enumerate(zip(self.trace_exposures, self.trace_channels)):
+                expos_group = trace_group.require_group(exposure['name'])
+                name = self.trace_name(exposure, channel)
+                size = offsets[i+1] - offsets[i]
+                if size == 0:
+                    dset = expos_group.create_dataset(name, shape=(0,), dtype=events_dset.dtype)
+                else:
+                    layout = h5py.VirtualLayout(shape=(size,), dtype=events_dset.dtype)
+                    layout[:] = h5py.VirtualSource(events_dset)[offsets[i]:offsets[i+1]]
+                    dset = expos_group.create_virtual_dataset(name, layout)
+                dset.attrs.update(events_dset.attrs) # each trace of events is encoded on its own
+
+
+def process_shot(writer, records_path, n_records):
+    """
+    Job of the pipeline pool, run in another process : decodes the raw
+    records the server handed over in the memory mapped file records_path,
+    removes the file and saves the shot with writer (a ShotWriter)
+
+    returns the statistics and the counts feedback of the shot
+    """
+    if n_records > 0:
+        records = np.memmap(records_path, dtype=np.uint32, mode='r', shape=(n_records,))
+    else:
+        records = np.zeros(0, dtype=np.uint32)
+    try:
+        sync_times, arrival_times, arrival_channels = writer.decode(records)
+    finally:
+        del records # unmapped before removing the file
+        if records_path is not None : os.remove(records_path)
+    stats = writer.save_traces(sync_times, arrival_times, arrival_channels)
+    return stats, writer.feedback
+
 
 class TH260Server(GenericServer):
     """
@@ -83,14 +757,42 @@ class TH260Server(GenericServer):
 
     interface_class = TH260_Card 
 
-    def __init__(self, port, name):
+    def __init__(self, port, name, devidx=0, record_path=None, pool=None):
         print("Setting attributes...")
         GenericServer.__init__(self, port)
         self.device_name = name
-        self.devidx=0
+        self.devidx=devidx
         self.card = self.get_card()
+        if record_path is not None : self.card.start_recording(record_path)
         self.exposures = None
+        self.config = None
+        self.arm_key = None
         self.acquisition_thread = None
+        self.timer = PhaseTimer()
+        self.stats_history = collections.deque(maxlen=STATS_HISTORY)
+        # pipeline mode : T2 shots are decoded and written by the multiprocessing pool, see submit_shot
+        self.pool = pool
+        self.pending = collections.deque() # (h5_filepath, AsyncResult) of the shots submitted to the pool
+        self.shot_counter = 0
+        self.segmenter = None # IncrementalSegmenter of the running shot, with incremental_segmentation
+        self.pending_lock = threading.Lock() # the pending shots are collected by the transitions and the 'stats' request
+        self.feedback_sock = None
+        self.feedback_lock = threading.Lock() # the feedback is published from the transition and the reactor threads
+        if FEEDBACK_PORT_OFFSET is not None:
+            self.feedback_sock = zmq.Context.instance().socket(zmq.PUB)
+            self.feedback_sock.setsockopt(zmq.LINGER, 0)
+            self.feedback_sock.bind('tcp://*:%d' % (port + FEEDBACK_PORT_OFFSET))
+        # live view, the card is shared between the live thread and the shots, see live_loop
+        self.live_sock = None
+        if LIVE_PORT_OFFSET is not None:
+            self.live_sock = zmq.Context.instance().socket(zmq.PUB)
+            self.live_sock.setsockopt(zmq.LINGER, 0)
+            self.live_sock.setsockopt(zmq.SNDHWM, 1) # frames are dropped, not queued, for a subscriber falling behind
+            self.live_sock.bind('tcp://*:%d' % (port + LIVE_PORT_OFFSET))
+        self.live_thread = None
+        self.live_stop = threading.Event()
+        self.card_lock = threading.Lock() # held by the live thread during each acquisition
+        self.shot_active = False # from the arming of a shot to its end, the live thread leaves the card alone
         print("Initialisation complete")
 
     def get_card(self):
@@ -100,23 +802,77 @@ class TH260Server(GenericServer):
         return self.interface_class(self.devidx)
 
         
-    def transition_to_buffered(self, h5_filepath):                       
+    def transition_to_buffered(self, h5_filepath, exposures=None, config=None, key=None):
+        """
+        Arms the card for the shot h5_filepath. The exposure table and config
+        are read from the shot file, unless the worker sent them along with
+        the request (see unpack_arm_request). A shot armed with the same key
+        as the previous one does not reconfigure the card.
+        """
         # Feedback
         print (self.device_name+' transition to buffered at %s' %(str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S.%f"'))))
+        self.timer = PhaseTimer()
+        with self.card_lock: # waits for the acquisition of the live view, if any
+            self.shot_active = True
 
-        with h5py.File(h5_filepath, 'r') as f:
-            group = f['devices'][self.device_name]
-            if not 'EXPOSURES' in group:
-                return {}
-            self._h5_filepath = h5_filepath
-            self.exposures = group['EXPOSURES'][:]
-            self.n_traces = len(self.exposures)
+        if exposures is None:
+            with self.timer.phase('read_shot_file'):
+                with h5py.File(h5_filepath, 'r') as f:
+                    group = f['devices'][self.device_name]
+                    if 'EXPOSURES' in group:
+                        exposures = group['EXPOSURES'][:]
+                    config = json.loads(group.attrs['server_config']) if 'server_config' in group.attrs else {}
+        if exposures is None or len(exposures) == 0:
+            self._h5_filepath = None
+            self.shot_active = False
+            return {}
+        self._h5_filepath = h5_filepath
+        self.exposures = exposures
+        self.n_traces = len(self.exposures)
+        self.config = dict(DEFAULT_CONFIG)
+        self.config.update(config)
+        if self.config['reducers'] : make_reducers(self.config['reducers']) # an unknown reducer fails the shot at arm, not once it is acquired
         print(self.exposures)
-        print("Configuring card for triggered acquisition.")
-        self.card.start_acquisition(acqTime=5000)
+        if key is not None and key == self.arm_key:
+            print("Same exposures and settings as the previous shot, card already configured.")
+        else:
+            print("Configuring card for triggered acquisition.")
+        stop_after_syncs = 2*self.n_traces if self.config['early_stop'] and self.config['measurement_mode'] == 'T2' else None
+        self.segmenter = None
+        if self.config['incremental_segmentation'] and self.config['measurement_mode'] == 'T2':
+            if self.pool is None and self.config['spill_threshold'] is None:
+                self.segmenter = IncrementalSegmenter(self.n_traces, self.config['channels'])
+            else:
+                print('incremental segmentation is not used with spill_threshold nor the pool, the shot is segmented at the end')
+        with self.timer.phase('arm'):
+            self.set_measurement_mode()
+            if hasattr(self.card, 'simulate_exposures') : self.card.simulate_exposures(self.exposures) # simulated card only
+            self.card.start_acquisition(acqTime=self.acquisition_time(), stream=True, config_key=key,
+                                        stop_after_syncs=stop_after_syncs, channels=self.config['channels'],
+                                        trigger_levels=self.config['input_trigger_levels'],
+                                        spill_threshold=self.config['spill_threshold'], spill_dir=SCRATCH_DIR,
+                                        chunk_consumer=None if self.segmenter is None else self.segmenter.feed) # the FiFo is drained during the shot
+        self.arm_key = key
 
         return {}
     
+    def set_measurement_mode(self):
+        """Reinitializes the card if the shot needs another measurement mode, binning or offset"""
+        mode, binning, offset = self.config['measurement_mode'], self.config['binning'], self.config['offset']
+        if (mode, binning, offset) != (self.card.mode, self.card.binning, self.card.offset):
+            self.card.initialize(mode, binning, offset)
+            self.arm_key = None
+
+    def acquisition_time(self):
+        """
+        Measurement time of the shot in ms : up to the end of the last exposure
+        and its sync padding, plus the acquisition margin of the config, which
+        has to cover the time between arming the card and the start of the shot
+        """
+        tmax = np.max(self.exposures['t'] + self.exposures['trigger_duration'])
+        acqTime = int(np.ceil(1000*(tmax + SYNC_PADDING_TIME + self.config['acquisition_margin'])))
+        return min(max(acqTime, 1), MAX_ACQUISITION_TIME)
+
     def transition_to_static(self, h5_filepath):           
         # Feedback
         print (self.device_name+' transition to static at %s' %(str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S.%f"'))))
@@ -124,70 +880,42 @@ class TH260Server(GenericServer):
         ### Write how to save and display traces 
         if self._h5_filepath is None:
             print('No traces in this shot.\n')
+            self.shot_active = False
             return True
 
-        self.traces = []
-        print ('reading buffer')
-        sync_times, arrival_times = self.card.readBuffer()
-        # print('sync times :') ; print(sync_times)
-        # print('arrival times :') ; print(arrival_times)
-        print('buffer read, saving trace')
-                
-        """
-        Sorting traces as a function of sync events :
-        """
-        sync_times = sync_times[:2*self.n_traces]  #we had to add 20 sync pulses at the end so the buffer transfer doesn't go crazy because of very low count numbers (see manual for TH260lib.dll, section 5.3)
-                                                    # so now we're just taking the right amount of flags, defined by the number of exposures we expect.
-        sync_flags=sync_times.copy()
-        # print(sync_flags)
-        # print(arrival_times)
-        while sync_flags.size > 1 :
-            self.traces.append(arrival_times[np.where((arrival_times > sync_flags[0]) & (arrival_times < sync_flags[1]))] - sync_flags[0])
-            sync_flags = sync_flags[2:]
-            # print(sync_flags)
-        if sync_flags.size == 1 :
-            print('last sync missed, sending all the rest')
-            self.traces.append((arrival_times[np.where(arrival_times > sync_flags[0])] - sync_flags[0]))
-            sync_flags = sync_flags[1:]
-        print(self.traces)
-        print("Saving {len(self.traces)}/{len(self.exposures)} traces.")
-
-        with h5py.File(self._h5_filepath, 'r+') as f:
-            trace_path = 'data/time_arrays/' + self.device_name
-            trace_group = f.require_group(trace_path)
-            trace_group.attrs['camera'] = self.device_name
-
-            # Whether we failed to get all the expected exposures:
-            trace_group.attrs['failed_shot'] = len(self.traces) != len(self.exposures)
-
-
-            # Iterate over expected exposures, sorted by acquisition time, to match them
-            # up with the acquired images:
-            self.exposures.sort(order='t')
-
-            dset = trace_group.create_dataset(
-                'sync_times',data=sync_times, dtype='float', compression='gzip'
-            )
-            dset = trace_group.create_dataset(
-                'arrival_times',data=arrival_times, dtype='float', compression='gzip'
-            )
-
-            traces = {
-                # (exposure['name'], exposure['frametype']): []
-                exposure['name']: []
-                for exposure in self.exposures
-            }
-            
-            for trace, exposure in zip(self.traces, self.exposures):
-                traces[exposure['name']].append(trace)
-                expos_group = trace_group.require_group(exposure['name'])
-                dset= expos_group.create_dataset(
-                    exposure['frametype'],data = trace, dtype='float', compression='gzip'
-                    )
-                # print(trace)
-
+        writer = ShotWriter(self.device_name, self._h5_filepath, self.exposures, self.config,
+                            self.card.resolution.value, self.timer)
+        writer.abort_event = self.abort_event
+        writer.on_feedback = self.publish_feedback
+        mode = self.config['measurement_mode']
+        try:
+            if mode != 'T2':
+                with self.timer.phase('read_buffer'):
+                    data = self.read_card_data()
+                writer.read_stats = self.card.read_stats
+                writer.telemetry = self.card.read_telemetry()
+                self.stats_history.append(writer.save_card_data(data))
+            elif self.pool is not None:
+                writer.feedback = self.submit_shot(writer)
+            else:
+                print ('reading buffer')
+                with self.timer.phase('read_buffer'):
+                    records = self.card.read_records()
+                writer.read_stats = self.card.read_stats
+                writer.telemetry = self.card.read_telemetry()
+                if self.segmenter is not None:
+                    sync_times, arrival_times, arrival_channels = writer.take_segments(self.segmenter)
+                else:
+                    sync_times, arrival_times, arrival_channels = writer.decode(records)
+                records = None
+                self.segmenter = None
+                print('buffer read, saving trace')
+                self.stats_history.append(writer.save_traces(sync_times, arrival_times, arrival_channels))
+        except Aborted:
+            writer.release_scratch()
+            raise
+        self.card.buffer.clear() # removes the records spilled to disk, if any
 
-        self.traces = None
         traces_to_send = None
 #         self.attributes_to_save = None
         self.exposures = None
@@ -195,8 +923,110 @@ class TH260Server(GenericServer):
         self.stop_acquisition_timeout = None
         self.exception_on_failed_shot = None
         print("Setting manual mode.\n")
+        self.shot_active = False
 
-        # return True  
+        return writer.feedback # counts of a T2 shot written here, sent back in the 'done' reply  
+
+    def read_card_data(self):
+        """Reads the data of a shot in T3 or histogram mode, as a dict of arrays named as saved by ShotWriter.save_card_data"""
+        if self.config['measurement_mode'] == 'T3':
+            print ('reading buffer')
+            return dict(zip(['nsync', 'dtime', 'channels', 'marker_nsync', 'marker_channels'], self.card.readT3Buffer()))
+        print ('reading histograms')
+        timeout = self.acquisition_time()/1000. + self.config['acquisition_margin']
+        return dict(('histogram_ch%d' % channel, counts) for channel, counts in self.card.read_histograms(timeout).items())
+
+    def submit_shot(self, writer):
+        """
+        Pipeline mode : hands the raw records of the shot over to the process
+        pool through a memory mapped file, to be decoded and written there
+        (see process_shot), out of the server process whose threads serve the
+        requests, the live view and the other cards. BLACS hands the shot file
+        over to lyse and the other workers once the transition returns, so
+        this waits until the pool has written it. An aborted shot is written
+        to the end by the pool, and collected by the next transition.
+
+        returns the counts feedback of the shot
+        """
+        print ('reading buffer')
+        with self.timer.phase('read_buffer'):
+            records = self.card.read_records()
+        writer.read_stats = self.card.read_stats
+        writer.telemetry = self.card.read_telemetry()
+        writer.abort_event = None # not picklable, a shot handed over to the pool is written to the end
+        writer.on_feedback = None # published once the shot is collected, see wait_pending
+        records_path = None
+        with self.timer.phase('handoff'):
+            if records.size > 0:
+                self.shot_counter += 1
+                records_path = os.path.join(SCRATCH_DIR or tempfile.gettempdir(),
+                                            'th260_%s_%d_%d.raw' % (self.device_name, os.getpid(), self.shot_counter))
+                mapped = np.memmap(records_path, dtype=np.uint32, mode='w+', shape=records.shape)
+                mapped[:] = records
+                mapped.flush()
+                del mapped
+        self.wait_pending() # a shot aborted while it was written
+        result = self.pool.apply_async(process_shot, (writer, records_path, records.size))
+        self.pending.append((self._h5_filepath, result))
+        print('records handed over to the pool')
+        while not result.ready():
+            if self.abort_event.is_set() : raise Aborted('%s aborted, left to the pool' % self._h5_filepath)
+            result.wait(REACTOR_POLL_INTERVAL/1000.)
+        self.wait_pending()
+        stats, feedback = result.get() # raises the error of the pool, as the shot would fail in the server
+        return feedback
+
+    def wait_pending(self, max_pending=0):
+        """
+        Collects the shots of the pipeline pool, oldest first, until at most
+        max_pending remain. Those already written are collected as well. A
+        shot that failed is reported and its error kept in the statistics.
+        """
+        with self.pending_lock:
+            while self.pending and (len(self.pending) > max_pending or self.pending[0][1].ready()):
+                h5_filepath, result = self.pending.popleft()
+                try:
+                    stats, feedback = result.get()
+                    self.stats_history.append(stats)
+                    if feedback is not None : self.publish_feedback(feedback)
+                except Exception as e:
+                    sys.stderr.write('Saving %s failed:\n%s\n' % (h5_filepath, str(e)))
+                    self.stats_history.append({'time': time.time(), 'h5_filepath': h5_filepath, 'error': str(e)})
+
+    def publish_feedback(self, feedback):
+        """Publishes the counts of a shot (see ShotWriter.counts_feedback) on the feedback socket"""
+        if self.feedback_sock is None : return
+        with self.feedback_lock:
+            self.feedback_sock.send_multipart([self.device_name.encode('utf8'), json.dumps(feedback).encode('utf8')])
+
+    def stats(self):
+        """
+        Statistics of the last STATS_HISTORY shots, see ShotWriter.write_stats.
+        Returned as JSON by the 'stats' request, which is answered while a
+        transition runs : the shots already written by the pool are only
+        collected here when no transition is collecting them.
+        """
+        if self.pending_lock.acquire(False):
+            self.pending_lock.release()
+            self.wait_pending(len(self.pending))
+        return {'device': self.device_name, 'shots': list(self.stats_history), 'telemetry': self.telemetry_summary()}
+
+    def telemetry_summary(self):
+        """
+        Rolling aggregates of the telemetry of the shots in the statistics
+        history : the highest sync and count rates, and the shots whose
+        card reported a full FiFo, a lost sync, dropped counts or warnings
+        """
+        shots = [shot for shot in self.stats_history if shot.get('telemetry_n_samples')]
+        summary = collections.OrderedDict()
+        summary['n_shots'] = len(shots)
+        if not shots : return summary
+        summary['max_sync_rate'] = max(shot['telemetry_max_sync_rate'] for shot in shots)
+        summary['max_count_rate'] = max(shot['telemetry_max_count_rate'] for shot in shots)
+        for name, flag in [('fifo_full', FLAG_FIFOFULL), ('sync_lost', FLAG_SYNC_LOST), ('counts_dropped', FLAG_CNTS_DROPPED)]:
+            summary['shots_' + name] = [shot['h5_filepath'] for shot in shots if shot['telemetry_flags'] & flag]
+        summary['shots_with_warnings'] = [shot['h5_filepath'] for shot in shots if shot['telemetry_warnings']]
+        return summary
 
     def abort(self):
         # if self.acquisition_thread is not None:
@@ -205,12 +1035,20 @@ class TH260Server(GenericServer):
         #     self.acquisition_thread = None
         #     self.card.stop_acquisition()
         # self.card._abort_acquisition = False
+        self.card.stop_streaming() # the streaming thread no longer reads the FiFo
+        with self.card_lock: # called by the reactor without a transition, while the live thread may be acquiring
+            self.card.stop_acquisition()
+            self.card.buffer.clear()
+        self.segmenter = None
+        self.arm_key = None
         self.traces = None
         self.n_traces = None
         self.exposures = None
+        self.config = None
         self.acquisition_thread = None
         self._h5_filepath = None
         self.exception_on_failed_shot = None
+        self.shot_active = False
         return True
 
     def abort_buffered(self):
@@ -222,14 +1060,129 @@ class TH260Server(GenericServer):
     def program_manual(self, values):
         return {}
 
+    def interrupt(self):
+        self.card.abort_acquisition()
+
+    def set_live(self, enabled):
+        """
+        Turns the live view on or off. While it is on, the card runs ungated
+        acquisitions of LIVE_ACQUISITION_TIME between the shots, and their
+        arrival time histograms and count rates are published on the live
+        socket (see live_loop).
+        """
+        if self.live_sock is None : raise ValueError('no live view, LIVE_PORT_OFFSET is None')
+        if enabled and self.live_thread is None:
+            self.live_stop.clear()
+            self.live_thread = threading.Thread(target=self.live_loop)
+            self.live_thread.daemon = True
+            self.live_thread.start()
+        elif not enabled and self.live_thread is not None:
+            self.live_stop.set()
+            self.live_thread.join()
+            self.live_thread = None
+
+    def live_loop(self):
+        """
+        Body of the live thread : acquires with TH260_Card.snap while no shot
+        is armed, adds each acquisition to a LiveHistogram and publishes it as
+        a JSON frame, at most LIVE_MAX_FPS times per s
+        """
+        monitor = None
+        resolution = None # of the card when monitor was made
+        last_frame = 0
+        while not self.live_stop.is_set():
+            with self.card_lock:
+                if self.shot_active:
+                    frame = None
+                else:
+                    try:
+                        if self.card.mode != 'T2':
+                            self.card.initialize('T2')
+                            self.arm_key = None
+                        records = self.card.snap(LIVE_ACQUISITION_TIME)
+                        if monitor is None or monitor.channels != self.card.channels or resolution != self.card.resolution.value:
+                            resolution = self.card.resolution.value
+                            monitor = LiveHistogram(self.card.channels, round(LIVE_BIN_WIDTH/(resolution*1e-12)), LIVE_N_BINS,
+                                                    LIVE_HISTORY, LIVE_RATE_POINTS)
+                        monitor.add(records, LIVE_ACQUISITION_TIME/1000.)
+                        records = None
+                        frame = None
+                        if time.time() - last_frame >= 1./LIVE_MAX_FPS:
+                            frame = monitor.frame(resolution, LIVE_MAX_POINTS)
+                            frame['card_count_rates'] = [self.card.get_cnt_rate(channel) for channel in monitor.channels]
+                    except Aborted:
+                        continue
+                    except Exception:
+                        sys.stderr.write('live view stopped:\n%s\n' % traceback.format_exc())
+                        self.live_thread = None
+                        return
+            if self.shot_active:
+                self.live_stop.wait(LIVE_ACQUISITION_TIME/1000.)
+            elif frame is not None:
+                frame['device'] = self.device_name
+                frame['time'] = time.time()
+                self.live_sock.send(json.dumps(frame).encode('utf8'))
+                last_frame = frame['time']
+
     def shutdown(self):
+        GenericServer.shutdown(self)
+        if self.live_sock is not None:
+            self.set_live(False)
+            self.live_sock.close()
+        self.wait_pending()
+        if self.feedback_sock is not None : self.feedback_sock.close()
         self.card.close()
     
-def start_main_server():
-    port = 1028
-    print("Starting TH260 server on port %d" % port)
-    th260_server = TH260Server(port, "th260")
-    th260_server.shutdown_on_interrupt()  
+def parse_card(spec):
+    """Parses a --card argument 'name:devidx:port'"""
+    try:
+        name, devidx, port = spec.split(':')
+        return name, int(devidx), int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected name:devidx:port, not '%s'" % spec)
+
+def record_path(name, n_cards):
+    """RECORD_PATH, suffixed by the device name when several cards record"""
+    if RECORD_PATH is None or n_cards == 1 : return RECORD_PATH
+    root, ext = os.path.splitext(RECORD_PATH)
+    return root + '_' + name + ext
+
+def start_main_server(argv=None):
+    """
+    Starts one TH260Server per card, all in this process. Each server has
+    its own port, card and streaming thread, and handles the transitions of
+    its device in its own thread, so the cards are read and their shots
+    written in parallel.
+    """
+    parser = argparse.ArgumentParser(description='TH260 server')
+    parser.add_argument('--card', action='append', type=parse_card, dest='cards', metavar='NAME:DEVIDX:PORT',
+                        help='card to drive, can be given several times (default %s)' % ' '.join(DEFAULT_CARDS))
+    parser.add_argument('--workers', type=int, default=0,
+                        help='pipeline mode : number of processes decoding and writing the T2 shots out of the server '
+                             'process, the shots of several cards in parallel (default 0, shots are written by the server)')
+    args = parser.parse_args(argv)
+    cards = args.cards or [parse_card(spec) for spec in DEFAULT_CARDS]
+    if len(set(name for name, devidx, port in cards)) != len(cards) or \
+       len(set(devidx for name, devidx, port in cards)) != len(cards) or \
+       len(set(port for name, devidx, port in cards)) != len(cards):
+        parser.error('the names, devidx and ports of the cards must be unique')
+
+    pool = multiprocessing.Pool(args.workers) if args.workers > 0 else None
+    servers = []
+    for name, devidx, port in cards:
+        print("Starting TH260 server for %s (card %d) on port %d" % (name, devidx, port))
+        servers.append(TH260Server(port, name, devidx, record_path=record_path(name, len(cards)), pool=pool))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print('KeyboardInterrupt, stopping.')
+    finally:
+        for server in servers:
+            server.shutdown()
+        if pool is not None:
+            pool.close()
+            pool.join()
         
 if __name__ == '__main__':
     start_main_server()           
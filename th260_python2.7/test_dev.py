@@ -0,0 +1,112 @@
+#####################################################################
+# Tests of TH260_dev against a simulated TH260lib
+#
+# FakeTH260Lib stands in for the DLL : the FiFo returns prepared chunks
+# of records, every other call succeeds
+#####################################################################
+
+import time
+import threading
+import ctypes as ct
+import unittest
+import numpy as np
+
+TIMEOUT = 10. # in s
+
+
+class FakeTH260Lib(object):
+
+    def __init__(self):
+        self.chunks = []
+        self.n_reads = 0
+        self.stopped = False
+
+    def load(self, records, chunk_size):
+        self.chunks = [records[i:i+chunk_size] for i in range(0, records.size, chunk_size)]
+        self.n_reads = 0
+        self.stopped = False
+
+    def TH260_ReadFiFo(self, devidx, pointer, n_max, n_records):
+        chunk = self.chunks.pop(0) if self.chunks and not self.stopped else np.zeros(0, dtype=np.uint32)
+        if chunk.size : self.n_reads += 1
+        ct.memmove(pointer, chunk.ctypes.data, 4*chunk.size)
+        n_records._obj.value = chunk.size
+        return 0
+
+    def TH260_StopMeas(self, devidx):
+        self.stopped = True # the card records nothing more
+        return 0
+
+    def __getattr__(self, name):
+        return lambda *args : 0
+
+
+ct.WinDLL = lambda path: FakeTH260Lib() # TH260_dev loads the DLL at import
+
+import TH260_dev
+from TH260_dev_dummy import synthetic_t2_records, DUMMY_EXPOSURES
+from TH260_processing import decode_t2
+
+
+def make_card():
+    lib = FakeTH260Lib()
+    TH260_dev.th260 = lib
+    card = TH260_dev.TH260_Card(0)
+    card.resolution.value = 250.
+    return card, lib
+
+
+def wait_for(condition):
+    t0 = time.time()
+    while not condition():
+        if time.time() - t0 > TIMEOUT : return False
+        time.sleep(0.01)
+    return True
+
+
+class StreamingTest(unittest.TestCase):
+
+    def test_many_chunks(self):
+        # more chunks than STREAM_QUEUE_SIZE, with nobody reading the records before the end of the shot
+        card, lib = make_card()
+        records = synthetic_t2_records(rate=1e5, seed=0)
+        n_chunks = 2*TH260_dev.STREAM_QUEUE_SIZE + 1
+        lib.load(records, records.size // n_chunks + 1)
+        card.start_acquisition(acqTime=1000, stream=True)
+        self.assertTrue(wait_for(lambda : not lib.chunks), 'the FiFo is not read during the shot')
+        self.assertGreater(lib.n_reads, TH260_dev.STREAM_QUEUE_SIZE)
+        np.testing.assert_array_equal(card.read_records(print_flag=False), records)
+        card.stop_streaming()
+
+    def test_early_stop(self):
+        # the measurement is stopped once the syncs of every exposure are read, even after more than STREAM_QUEUE_SIZE chunks
+        card, lib = make_card()
+        records = synthetic_t2_records(rate=1e5, seed=1)
+        n_chunks = 2*TH260_dev.STREAM_QUEUE_SIZE + 1
+        lib.load(records, records.size // n_chunks + 1)
+        n_syncs = 2*len(DUMMY_EXPOSURES)
+        card.start_acquisition(acqTime=1000, stream=True, stop_after_syncs=n_syncs)
+        self.assertTrue(wait_for(lambda : lib.stopped), 'the measurement is not stopped')
+        self.assertGreater(lib.n_reads, TH260_dev.STREAM_QUEUE_SIZE)
+        self.assertTrue(lib.chunks, 'the measurement is stopped at the end of the shot only')
+        sync_times, times, channels, oflcorrection = decode_t2(card.read_records(print_flag=False))
+        self.assertGreaterEqual(sync_times.size, n_syncs)
+        card.stop_streaming()
+
+    def test_telemetry_while_collector_lags(self):
+        # the consumer holds the collector, the queue fills up and the streaming thread waits for room
+        card, lib = make_card()
+        records = synthetic_t2_records(rate=1e5, seed=2)
+        lib.load(records, records.size // (2*TH260_dev.STREAM_QUEUE_SIZE) + 1)
+        release = threading.Event()
+        card.start_acquisition(acqTime=1000, stream=True, chunk_consumer=lambda chunk : release.wait())
+        self.assertTrue(wait_for(lambda : card.stream_chunks.full()), 'the queue does not fill up')
+        n_samples = len(card.telemetry)
+        self.assertTrue(wait_for(lambda : len(card.telemetry) > n_samples + 2), 'no telemetry while the queue is full')
+        release.set()
+        np.testing.assert_array_equal(card.read_records(print_flag=False), records)
+        card.stop_streaming()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,289 @@
+#####################################################################
+# Tests of TH260_processing
+#
+# run with `python -m pytest test_processing.py` or
+# `python -m unittest test_processing` from this directory
+#####################################################################
+
+import unittest
+import numpy as np
+import h5py
+
+import TH260_processing
+from TH260_processing import segment_bounds, segment_traces, IncrementalSegmenter, demultiplex, decode_t2, encode_t2, decode_t3, T2WRAPAROUND, T3WRAPAROUND, correlate, create_time_dataset, \
+                             read_timestamps, read_ragged_trace, make_reducers
+
+
+def baseline_traces(arrival_times, sync_times):
+    """Segmentation loop of the original server, which segment_bounds replaces"""
+    traces = []
+    sync_flags = sync_times.copy()
+    while sync_flags.size > 1 :
+        traces.append(arrival_times[np.where((arrival_times > sync_flags[0]) & (arrival_times < sync_flags[1]))] - sync_flags[0])
+        sync_flags = sync_flags[2:]
+    if sync_flags.size == 1 :
+        traces.append((arrival_times[np.where(arrival_times > sync_flags[0])] - sync_flags[0]))
+    return traces
+
+
+class SegmentationTest(unittest.TestCase):
+
+    def assert_same_traces(self, arrival_times, sync_times):
+        traces, opens = segment_traces(arrival_times, sync_times)
+        expected = baseline_traces(arrival_times, sync_times)
+        self.assertEqual(len(traces), len(expected))
+        for trace, t0, expected_trace in zip(traces, opens, expected):
+            np.testing.assert_array_equal(trace - t0, expected_trace)
+
+    def test_random_shot(self):
+        rng = np.random.RandomState(0)
+        arrival_times = np.sort(rng.uniform(0, 1, 10000))
+        sync_times = np.sort(rng.uniform(0, 1, 20))
+        self.assert_same_traces(arrival_times, sync_times)
+
+    def test_last_sync_missed(self):
+        rng = np.random.RandomState(1)
+        arrival_times = np.sort(rng.uniform(0, 1, 1000))
+        sync_times = np.array([0.1, 0.2, 0.4, 0.5, 0.7])
+        self.assert_same_traces(arrival_times, sync_times)
+        starts, stops, opens = segment_bounds(arrival_times, sync_times)
+        self.assertEqual(stops[-1], arrival_times.size)
+
+    def test_photons_at_sync_times(self):
+        # photons at a marker belong to no trace, as with the strict comparisons of the baseline loop
+        arrival_times = np.array([0, 1, 1, 2, 3, 3, 4, 5, 6, 6, 7], dtype=np.uint64)
+        sync_times = np.array([1, 3, 3, 6, 6], dtype=np.uint64)
+        self.assert_same_traces(arrival_times, sync_times)
+        traces, opens = segment_traces(arrival_times, sync_times)
+        self.assertEqual([trace.tolist() for trace in traces], [[2], [4, 5], [7]])
+
+    def test_empty(self):
+        self.assert_same_traces(np.zeros(0), np.array([0.1, 0.2]))
+        self.assert_same_traces(np.array([0.15]), np.zeros(0))
+
+
+class IncrementalSegmenterTest(unittest.TestCase):
+
+    channels = [0, 1]
+
+    def make_shot(self, seed, n_exposures, n_padding):
+        """Raw records of a T2 shot over several wraparounds, with photons at some sync times and an empty exposure"""
+        rng = np.random.RandomState(seed)
+        sync_times = np.cumsum(rng.randint(1, T2WRAPAROUND // 5, 2*n_exposures + n_padding)).astype(np.uint64)
+        sync_times[2] = sync_times[1] + 1 # exposure 1 opens and closes with no photon inside
+        sync_times[3] = sync_times[2] + 1
+        times = np.sort(np.concatenate((rng.randint(0, int(sync_times[-1]) + 1000, 500), sync_times[::3]))).astype(np.uint64)
+        times = times[(times <= sync_times[1]) | (times > sync_times[3])]
+        channels = rng.randint(0, 2, times.size)
+        return encode_t2(sync_times, times, channels)
+
+    def assert_same_segments(self, records, cuts, n_exposures):
+        sync_times, times, channels, oflcorrection = decode_t2(records)
+        channel_times = demultiplex(times, channels, self.channels)
+        segmenter = IncrementalSegmenter(n_exposures, self.channels)
+        for start, stop in zip(cuts[:-1], cuts[1:]):
+            segmenter.feed(records[start:stop])
+        result = segmenter.finish()
+        for array, expected_array in zip(result[:3], (sync_times, times, channels)):
+            np.testing.assert_array_equal(array, expected_array)
+        for channel in self.channels:
+            np.testing.assert_array_equal(result[3][channel], channel_times[channel])
+            starts, stops, opens = segment_bounds(channel_times[channel], sync_times[:2*n_exposures])
+            np.testing.assert_array_equal(result[4][channel][0], starts)
+            np.testing.assert_array_equal(result[4][channel][1], stops)
+
+    def test_chunks(self):
+        rng = np.random.RandomState(9)
+        for n_padding in [20, 0]: # syncs after the last exposure, or its closing marker missed
+            records = self.make_shot(10, 5, n_padding)
+            syncs = np.flatnonzero((records >> 31 == 1) & ((records >> 25) & 0x3F != 0x3F))
+            if n_padding == 0 : records = records[:syncs[-1]]
+            for cuts in [[], # whole
+                         rng.randint(0, records.size, 50), # random sizes, some empty
+                         np.concatenate((syncs[0:10:2], syncs[0:10:2] + 1)), # right before and after each opening sync
+                         np.arange(records.size)]: # one record at a time
+                cuts = np.sort(np.asarray(cuts, dtype=np.int64))
+                self.assert_same_segments(records, np.concatenate(([0], cuts, [records.size])), 5)
+
+
+def encode_t3(nsync, dtime, channels, marker_nsync, marker_channels):
+    """
+    Raw T3 records of photons and markers at absolute sync indices, with an
+    overflow record before each event that follows a wraparound : a single
+    wraparound is written with an nsync of 0, as older firmware does, several
+    with their number
+    """
+    nsync = np.concatenate((nsync, marker_nsync)).astype(np.uint64)
+    words = np.concatenate((np.asarray(dtime, dtype=np.uint32) << 10 | np.asarray(channels, dtype=np.uint32) << 25,
+                            np.uint32(1 << 31) | np.asarray(marker_channels, dtype=np.uint32) << 25))
+    order = np.argsort(nsync, kind='mergesort')
+    nsync, words = nsync[order], words[order]
+    records = []
+    wraps = 0
+    for n, word in zip(nsync, words):
+        jump = int(n // T3WRAPAROUND) - wraps
+        if jump > 0:
+            records.append((1 << 31) | (0x3F << 25) | (0 if jump == 1 else jump))
+            wraps += jump
+        records.append(int(word) | int(n % T3WRAPAROUND))
+    return np.array(records, dtype=np.uint32)
+
+
+class RecordCodingTest(unittest.TestCase):
+
+    def test_t2(self):
+        rng = np.random.RandomState(2)
+        times = np.sort(rng.randint(0, 5*T2WRAPAROUND, 1000)).astype(np.uint64)
+        sync_times = np.sort(rng.randint(0, 5*T2WRAPAROUND, 10)).astype(np.uint64)
+        channels = rng.randint(0, 2, times.size)
+        decoded_syncs, decoded_times, decoded_channels, oflcorrection = decode_t2(encode_t2(sync_times, times, channels))
+        np.testing.assert_array_equal(decoded_syncs, sync_times)
+        np.testing.assert_array_equal(decoded_times, times)
+        np.testing.assert_array_equal(decoded_channels, channels)
+
+    def test_t3(self):
+        rng = np.random.RandomState(6)
+        # gaps of zero, one and several wraparounds between events
+        nsync = np.cumsum(rng.choice([0, 5, T3WRAPAROUND, 3*T3WRAPAROUND + 7], size=500)).astype(np.uint64)
+        dtime = rng.randint(0, 2**15, nsync.size)
+        channels = rng.randint(0, 2, nsync.size)
+        marker_nsync = np.sort(rng.choice(nsync, 20))
+        marker_channels = rng.choice([1, 2, 4, 8], 20)
+        records = encode_t3(nsync, dtime, channels, marker_nsync, marker_channels)
+        overflows = records[records >> 25 == (1 << 6) | 0x3F] & 0x3FF
+        self.assertTrue(np.any(overflows == 0) and np.any(overflows > 1)) # single and multiple wraparounds
+        expected = (nsync, dtime, channels, marker_nsync, marker_channels)
+        decoded = decode_t3(records)
+        for array, expected_array in zip(decoded[:5], expected):
+            np.testing.assert_array_equal(array, expected_array)
+        # in chunks, the overflow correction carried from one to the next
+        chunks = [decode_t3(records[:301])]
+        chunks.append(decode_t3(records[301:], chunks[0][-1]))
+        for i, expected_array in enumerate(expected):
+            np.testing.assert_array_equal(np.concatenate([chunk[i] for chunk in chunks]), expected_array)
+
+
+def brute_force_correlation(times_a, times_b, bin_width, max_lag, auto):
+    """Histogram of correlate, made from every pair of photons"""
+    n_bins = int(np.ceil(max_lag / float(bin_width)))
+    delays = np.subtract.outer(np.asarray(times_b, dtype=float), np.asarray(times_a, dtype=float)) # [j, i] is b[j] - a[i]
+    keep = np.abs(delays) <= max_lag
+    if auto : np.fill_diagonal(keep, False)
+    bins = np.floor((delays[keep] + n_bins*bin_width) / bin_width).astype(np.int64)
+    return np.bincount(bins[(bins >= 0) & (bins < 2*n_bins)], minlength=2*n_bins)
+
+
+class CorrelationTest(unittest.TestCase):
+
+    def test_brute_force(self):
+        rng = np.random.RandomState(5)
+        # few distinct times, so that many delays are exactly 0 or +-max_lag
+        a = np.sort(rng.randint(0, 2000, 300)).astype(np.uint64)
+        b = np.sort(rng.randint(0, 2000, 200)).astype(np.uint64)
+        for unit in [None, 0.5]: # tags, then times in s (exact in float)
+            for bin_width, max_lag in [(10, 50), (7, 50), (1, 3)]:
+                for times_a, times_b, auto in [(a, a, True), (a, b, False)]:
+                    width, lag = bin_width, max_lag
+                    if unit is not None:
+                        times_a, times_b, width, lag = times_a*unit, times_b*unit, width*unit, lag*unit
+                    hist, edges = correlate(times_a, times_b, width, lag, auto=auto)
+                    np.testing.assert_array_equal(hist, brute_force_correlation(times_a, times_b, width, lag, auto))
+                    self.assertEqual(edges.size, hist.size + 1)
+
+    def test_blocks(self):
+        # photons and pairs in blocks down to a single one, the pairs of a photon then spanning several blocks
+        rng = np.random.RandomState(7)
+        a = np.sort(rng.randint(0, 2000, 300)).astype(np.uint64)
+        b = np.sort(rng.randint(0, 2000, 200)).astype(np.uint64)
+        expected = [correlate(a, a, 7, 50, auto=True)[0], correlate(a, b, 7, 50)[0]]
+        block = TH260_processing.CORRELATION_BLOCK
+        try:
+            for size in [1, 5, 64]:
+                TH260_processing.CORRELATION_BLOCK = size
+                np.testing.assert_array_equal(correlate(a, a, 7, 50, auto=True)[0], expected[0])
+                np.testing.assert_array_equal(correlate(a, b, 7, 50)[0], expected[1])
+        finally:
+            TH260_processing.CORRELATION_BLOCK = block
+
+
+class ReducerTest(unittest.TestCase):
+
+    def reduce(self, times, block_size):
+        reducers = make_reducers(['counts', 'moments', ['histogram', {'bin_width': 0.1, 'n_bins': 8}]])
+        for reducer in reducers : reducer.start()
+        for start in range(0, times.size, block_size):
+            for reducer in reducers : reducer.update(times[start:start + block_size])
+        return [value for reducer in reducers for value in reducer.result()]
+
+    def test_blocks(self):
+        times = np.sort(np.random.RandomState(8).uniform(0, 1, 1000))
+        expected = [times.size, times[0], times[-1], np.mean(times), np.std(times),
+                    np.bincount((times // 0.1).astype(np.int64)[times < 0.8], minlength=8)]
+        for block_size in [1, 7, 1000]:
+            result = self.reduce(times, block_size)
+            self.assertEqual(result[:3], expected[:3])
+            np.testing.assert_allclose(result[3:5], expected[3:5], rtol=1e-12)
+            np.testing.assert_array_equal(result[5], expected[5])
+
+    def test_empty(self):
+        result = self.reduce(np.zeros(0), 7)
+        self.assertEqual(result[0], 0)
+        self.assertTrue(np.all(np.isnan(result[1:5])))
+        np.testing.assert_array_equal(result[5], np.zeros(8))
+
+
+class StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.file = h5py.File('storage_test.h5', 'w', driver='core', backing_store=False)
+        rng = np.random.RandomState(3)
+        self.tags = np.sort(rng.randint(0, 2**40, 1000)).astype(np.uint64)
+        self.seconds = np.sort(rng.uniform(0, 1, 1000))
+
+    def tearDown(self):
+        self.file.close()
+
+    def assert_round_trip(self, data, dtype, encoding, origin=None, block_size=None):
+        kwargs = {} if block_size is None else {'block_size': block_size}
+        dset = create_time_dataset(self.file, 'times', data, dtype, encoding, origin=origin, **kwargs)
+        expected = data if origin is None else data - origin
+        np.testing.assert_array_equal(read_timestamps(dset), expected)
+        del self.file['times']
+
+    def test_tags(self):
+        for encoding in ['plain', 'delta']:
+            for block_size in [None, 64, 1000, 999]: # whole, in blocks, at and just below the size
+                self.assert_round_trip(self.tags, np.uint64, encoding, block_size=block_size)
+                self.assert_round_trip(self.tags, np.uint64, encoding, origin=self.tags[0], block_size=block_size)
+
+    def test_seconds(self):
+        for block_size in [None, 64]:
+            self.assert_round_trip(self.seconds, 'float', 'plain', block_size=block_size)
+            self.assert_round_trip(self.seconds, 'float', 'plain', origin=0.25, block_size=block_size)
+
+    def test_ragged(self):
+        # traces relative to their opening sync, one after the other, as ShotWriter.write_ragged writes them
+        rng = np.random.RandomState(4)
+        offsets = np.concatenate(([0], np.sort(rng.randint(0, self.tags.size, 9)), [self.tags.size]))
+        events = self.tags.copy()
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            if stop > start : events[start:stop] -= events[start]
+        table = np.zeros(len(offsets) - 1, dtype=[('name', h5py.special_dtype(vlen=str)),
+                                                  ('frametype', h5py.special_dtype(vlen=str)), ('channel', np.uint8)])
+        table['name'] = ['exposure%d' % i for i in range(table.size)]
+        table['frametype'] = 'frame'
+        self.file.create_dataset('offsets', data=offsets)
+        self.file.create_dataset('exposures', data=table)
+        for encoding in ['plain', 'delta']:
+            for block_size in [None, 64]:
+                kwargs = {} if block_size is None else {'block_size': block_size}
+                dset = create_time_dataset(self.file, 'events', events, np.uint64, encoding, starts=offsets[:-1], **kwargs)
+                np.testing.assert_array_equal(read_timestamps(dset, offsets), events)
+                for i in range(table.size):
+                    np.testing.assert_array_equal(read_ragged_trace(self.file, 'exposure%d' % i, 'frame'),
+                                                  events[offsets[i]:offsets[i+1]])
+                del self.file['events']
+
+
+if __name__ == '__main__':
+    unittest.main()